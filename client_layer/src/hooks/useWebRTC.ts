@@ -21,7 +21,21 @@ export const useWebRTC = ({ roomId, userId, onConnect }: WebRTCProps) => {
     const remoteStreams = useRef<{ [key: string]: MediaStream }>({}); // buffer for streams
 
     const WS_BASE_URL = import.meta.env.VITE_WS_URL || 'ws://localhost:8001';
-    const WS_URL = `${WS_BASE_URL}/ws/${roomId}/${userId}`;
+    const WS_URL = `${WS_BASE_URL}/ws/${roomId}/${userId}?caps=candidates,heartbeat`;
+
+    // Ask the signaling layer which node holds this room, so the room stays on one node.
+    const getSocketUrl = useCallback(async () => {
+        try {
+            const response = await fetch(`${WS_BASE_URL.replace(/^ws/, 'http')}/route/${roomId}`);
+            if (response.ok) {
+                const { url } = await response.json();
+                return `${url}/ws/${roomId}/${userId}?caps=candidates,heartbeat`;
+            }
+        } catch (e) {
+            console.error("Room routing failed, using the default node:", e);
+        }
+        return WS_URL;
+    }, [WS_BASE_URL, WS_URL, roomId, userId]);
 
 
     useEffect(() => {
@@ -46,7 +60,7 @@ export const useWebRTC = ({ roomId, userId, onConnect }: WebRTCProps) => {
         fetchHistory();
     }, [roomId]);
 
-    const { sendMessage, lastMessage, readyState } = useWebSocket(WS_URL, {
+    const { sendMessage, lastMessage, readyState } = useWebSocket(getSocketUrl, {
         onOpen: () => {
             console.log('Connected to Signaling Server');
             startLocalVideo();
@@ -182,6 +196,23 @@ export const useWebRTC = ({ roomId, userId, onConnect }: WebRTCProps) => {
                         if (pc) pc.addIceCandidate(new RTCIceCandidate(msg.data));
                     }
                     break;
+                case 'candidates':
+                    if (String(msg.target_id) === myId) {
+                        const pc = peerConnections.current[senderId];
+                        if (pc) msg.data.forEach((c: RTCIceCandidateInit) => pc.addIceCandidate(new RTCIceCandidate(c)));
+                    }
+                    break;
+                case 'ping':
+                    sendMessage(JSON.stringify({ type: 'pong' }));
+                    break;
+                case 'throttled':
+                    // Messages of this type are dropped by the server until retry_after_ms has passed.
+                    console.warn(`Signaling rate limit hit for ${msg.msg_type} (${msg.scope}), retry in ${msg.retry_after_ms}ms`);
+                    break;
+                case 'reconnect':
+                    // The node is draining: it closes us with 1012 after delay_ms and we reconnect elsewhere.
+                    console.log(`Signaling node restarting, reconnecting in ${msg.delay_ms}ms`);
+                    break;
                 case 'user_left':
                     if (peerConnections.current[senderId]) {
                         peerConnections.current[senderId].close();
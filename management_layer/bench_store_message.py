@@ -0,0 +1,90 @@
+"""StoreMessage persistence benchmark: per-row commits vs the write-behind batcher.
+
+Inserts messages for an existing room and user against the database in
+database.py, reports sustained inserts/s for each path, then deletes the
+rows it wrote.
+
+    python bench_store_message.py [messages] [senders]
+"""
+import sys
+import threading
+import time
+
+import database, models
+from message_writer import MessageWriter
+
+MARKER = "__bench_store_message__"
+
+
+def pick_room_and_user():
+    db = database.SessionLocal()
+    try:
+        room = db.query(models.Room).first()
+        user = db.query(models.User).first()
+        if room is None or user is None:
+            sys.exit("Needs at least one room and one user in the database")
+        return room.id, user.id
+    finally:
+        db.close()
+
+
+def store_per_row(room_id, user_id, content):
+    """What StoreMessage used to do for every chat line."""
+    db = database.SessionLocal()
+    try:
+        ban = db.query(models.RoomBan).filter(
+            models.RoomBan.room_id == room_id,
+            models.RoomBan.user_id == user_id
+        ).first()
+        if ban:
+            return
+        db.add(models.Message(room_id=room_id, user_id=user_id, content=content))
+        db.commit()
+    finally:
+        db.close()
+
+
+def run_senders(n, senders, send):
+    per_sender = n // senders
+    threads = [
+        threading.Thread(target=lambda: [send(f"{MARKER} {i}") for i in range(per_sender)])
+        for _ in range(senders)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return per_sender * senders, start
+
+
+def cleanup():
+    db = database.SessionLocal()
+    try:
+        db.query(models.Message).filter(models.Message.content.startswith(MARKER)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    senders = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    room_id, user_id = pick_room_and_user()
+
+    total, start = run_senders(n, senders, lambda content: store_per_row(room_id, user_id, content))
+    elapsed = time.perf_counter() - start
+    print(f"{'per-row commit':<16} {total / elapsed:>10,.0f} inserts/s")
+    cleanup()
+
+    writer = MessageWriter()
+    writer.start()
+    total, start = run_senders(n, senders, lambda content: writer.submit(room_id, user_id, content))
+    writer.close(timeout=300)
+    elapsed = time.perf_counter() - start
+    print(f"{'write-behind':<16} {writer.written / elapsed:>10,.0f} inserts/s   {writer.batches} batches, {total - writer.written} not written")
+    cleanup()
+
+
+if __name__ == "__main__":
+    main()
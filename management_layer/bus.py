@@ -0,0 +1,55 @@
+"""Publishing onto the signaling layer's Redis bus.
+
+Messages are wrapped in the signaling layer's routing envelope
+(signaling_layer/envelope.py) and sent with the same backend settings the
+signaling nodes read: BUS_BACKEND, STREAM_MAXLEN and STREAM_TTL. One client
+is shared by every caller.
+"""
+import json
+import os
+
+import redis
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+BUS_BACKEND = os.getenv("BUS_BACKEND", "pubsub")
+STREAM_MAXLEN = int(os.getenv("STREAM_MAXLEN", 1000))
+STREAM_TTL = int(os.getenv("STREAM_TTL", 3600))
+
+ORIGIN = "management"
+
+_redis = redis.Redis.from_url(REDIS_URL)
+
+
+def pack(msg_type: str, room_id: int, target_id, message: dict) -> bytes:
+    """<type> US <origin> US <room> US <target> US <codec> RS <JSON payload>"""
+    target = "" if target_id is None else target_id
+    header = "\x1f".join((msg_type, ORIGIN, str(room_id), str(target), "j"))
+    return header.encode() + b"\x1e" + json.dumps(message).encode()
+
+
+def publish(channel: str, data: bytes):
+    if BUS_BACKEND == "streams":
+        key = f"stream:{channel}"
+        pipe = _redis.pipeline(transaction=False)
+        pipe.xadd(key, {"d": data}, maxlen=STREAM_MAXLEN, approximate=True)
+        pipe.expire(key, STREAM_TTL)
+        pipe.execute()
+    else:
+        _redis.publish(channel, data)
+
+
+def notify_ban(room_id: int, user_id: int):
+    """Tells every signaling node to drop its cached admission for this user and room."""
+    try:
+        publish("global_control", pack("ban_created", room_id, user_id, {}))
+    except Exception as e:
+        print(f"Failed to publish ban invalidation to Redis: {e}")
+
+
+def kick_user(room_id: int, user_id: int):
+    """Disconnects the user from the room on whichever node holds them."""
+    try:
+        publish(f"room:{room_id}", pack("system_kick", room_id, user_id, {"type": "system_kick", "user_id": user_id}))
+        print(f"Sent output kick for user {user_id} in room {room_id}")
+    except Exception as e:
+        print(f"Failed to send kick message to Redis: {e}")
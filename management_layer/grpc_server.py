@@ -3,14 +3,29 @@ from concurrent import futures
 import service_pb2
 import service_pb2_grpc
 import database, models
+from occupancy import occupancy, SHARED_NODE
+from message_writer import message_writer
+from bus import notify_ban
+from tracing import traced, instrument_engine
 from sqlalchemy.orm import Session
 from passlib.context import CryptContext
 from jose import jwt
+import signal
+import threading
 
 pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
 SECRET_KEY = "super-secret-key-change-this-in-production"
 ALGORITHM = "HS256"
 
+instrument_engine(database.engine)
+
+
+def _node_id(context) -> str:
+    for key, value in context.invocation_metadata():
+        if key == "x-node-id":
+            return value
+    return SHARED_NODE
+
 class ManagementService(service_pb2_grpc.ManagementServiceServicer):
     
 
@@ -68,18 +83,20 @@ class ManagementService(service_pb2_grpc.ManagementServiceServicer):
         db: Session = database.SessionLocal()
         try:
             rooms = db.query(models.Room).filter(models.Room.is_active == True).all()
+            counts = occupancy.live_counts()
             response_rooms = []
             for r in rooms:
                 response_rooms.append(service_pb2.RoomResponse(
                     id=r.id,
                     name=r.name,
                     max_participants=r.max_participants,
-                    current_participants=r.current_participants
+                    current_participants=r.current_participants if counts is None else counts.get(r.id, 0)
                 ))
             return service_pb2.RoomListResponse(rooms=response_rooms)
         finally:
             db.close()
 
+    @traced
     def ValidateJoin(self, request, context):
         db: Session = database.SessionLocal()
         try:
@@ -98,56 +115,22 @@ class ManagementService(service_pb2_grpc.ManagementServiceServicer):
         finally:
             db.close()
 
+    @traced
     def UserJoined(self, request, context):
-        db: Session = database.SessionLocal()
-        try:
-            room = db.query(models.Room).filter(models.Room.id == request.room_id).first()
-            if room:
-                room.current_participants += 1
-                room.is_active = True
-                db.commit()
-            return service_pb2.JoinResponse(allowed=True, reason="Joined")
-        finally:
-            db.close()
+        # Live occupancy is in Redis; the reconciler copies it to rooms.current_participants.
+        occupancy.adjust(_node_id(context), request.room_id, 1)
+        return service_pb2.JoinResponse(allowed=True, reason="Joined")
 
+    @traced
     def UserLeft(self, request, context):
-        db: Session = database.SessionLocal()
-        try:
-            room = db.query(models.Room).filter(models.Room.id == request.room_id).first()
-            if room:
-                room.current_participants -= 1
-                if room.current_participants <= 0:
-                    room.current_participants = 0
-                    room.is_active = False
-                    # db.delete(room)
-                db.commit()
-            return service_pb2.JoinResponse(allowed=True, reason="Left")
-        finally:
-            db.close()
+        occupancy.adjust(_node_id(context), request.room_id, -1)
+        return service_pb2.JoinResponse(allowed=True, reason="Left")
 
+    @traced
     def StoreMessage(self, request, context):
-        db: Session = database.SessionLocal()
-        try:
-            ban = db.query(models.RoomBan).filter(
-                models.RoomBan.room_id == request.room_id,
-                models.RoomBan.user_id == request.user_id
-            ).first()
-            if ban:
-                return service_pb2.MessageResponse(success=False)
-
-            new_msg = models.Message(
-                room_id=request.room_id,
-                user_id=request.user_id,
-                content=request.content
-            )
-            db.add(new_msg)
-            db.commit()
-            return service_pb2.MessageResponse(success=True)
-        except Exception:
-            db.rollback()
-            return service_pb2.MessageResponse(success=False)
-        finally:
-            db.close()
+        # Ban check and insert happen in message_writer's next batch.
+        accepted = message_writer.submit(request.room_id, request.user_id, request.content)
+        return service_pb2.MessageResponse(success=accepted)
 
     def BlockUser(self, request, context):
         db: Session = database.SessionLocal()
@@ -179,6 +162,7 @@ class ManagementService(service_pb2_grpc.ManagementServiceServicer):
             )
             db.add(new_ban)
             db.commit()
+            notify_ban(request.room_id, request.user_to_block_id)
             return service_pb2.BlockResponse(success=True)
             
         except Exception as e:
@@ -187,11 +171,22 @@ class ManagementService(service_pb2_grpc.ManagementServiceServicer):
             db.close()
 
 def serve():
+    """Standalone gRPC server, with the same background workers main.py starts."""
+    message_writer.start()
+    threading.Thread(target=occupancy.run_reconciler, daemon=True).start()
+
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
     service_pb2_grpc.add_ManagementServiceServicer_to_server(ManagementService(), server)
     server.add_insecure_port('0.0.0.0:50051')
     server.start()
-    server.wait_for_termination()
+    # SIGTERM stops taking RPCs; the queued chat messages are drained below.
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop(grace=2))
+    try:
+        server.wait_for_termination()
+    except KeyboardInterrupt:
+        server.stop(grace=2).wait()
+    finally:
+        message_writer.close()
 
 if __name__ == '__main__':
     serve()
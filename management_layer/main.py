@@ -9,6 +9,9 @@ import time
 import database, models
 import auth, rooms
 import grpc_server
+from occupancy import occupancy
+from message_writer import message_writer
+from tracing import tracer
 import service_pb2_grpc
 
 models.Base.metadata.create_all(bind=database.engine)
@@ -26,10 +29,19 @@ app.add_middleware(
 app.include_router(auth.router)
 app.include_router(rooms.router)
 
+@app.get("/stats/traces")
+def trace_dump(min_ms: float = 0, limit: int = 50, trace_id: str = None):
+    """Servicer and SQL spans recorded for signaling-layer traces, newest first."""
+    return tracer.dump(min_ms=min_ms, limit=limit, trace_id=trace_id)
+
+grpc_server_instance = None
+
 def run_grpc_server():
     """Runs the gRPC server in a separate thread."""
+    global grpc_server_instance
     print("Starting gRPC Server on :50051...")
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    grpc_server_instance = server
     service_pb2_grpc.add_ManagementServiceServicer_to_server(grpc_server.ManagementService(), server)
     server.add_insecure_port('0.0.0.0:50051')
     server.start()
@@ -37,11 +49,21 @@ def run_grpc_server():
 
 @app.on_event("startup")
 async def startup_event():
+    message_writer.start()
 
     t = threading.Thread(target=run_grpc_server, daemon=True)
     t.start()
     print("gRPC server started.")
 
+    threading.Thread(target=occupancy.run_reconciler, daemon=True).start()
+
+@app.on_event("shutdown")
+def shutdown_event():
+    # Stop taking RPCs first, then drain whatever chat messages are still queued.
+    if grpc_server_instance is not None:
+        grpc_server_instance.stop(grace=2).wait()
+    message_writer.close()
+
 if __name__ == '__main__':
 
     print("Starting HTTP Server :8000...")
@@ -0,0 +1,146 @@
+import datetime
+import os
+import queue
+import threading
+import time
+
+from sqlalchemy import insert, tuple_
+from sqlalchemy.exc import OperationalError
+
+import database, models
+
+MESSAGE_FLUSH_MS = float(os.getenv("MESSAGE_FLUSH_MS", 50))
+MESSAGE_BATCH_MAX = int(os.getenv("MESSAGE_BATCH_MAX", 500))
+MESSAGE_QUEUE_MAX = int(os.getenv("MESSAGE_QUEUE_MAX", 50000))
+
+
+class MessageWriter:
+    """Write-behind queue for chat messages.
+
+    StoreMessage only enqueues. A single flusher thread wakes every
+    MESSAGE_FLUSH_MS (or as soon as MESSAGE_BATCH_MAX rows are waiting), drops
+    rows from banned users with one query for the whole batch, and writes the
+    rest with one multi-row INSERT and one COMMIT. close() drains everything
+    still queued before returning.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=MESSAGE_QUEUE_MAX)
+        self.stopping = threading.Event()
+        self.thread = None
+
+        self.written = 0
+        self.rejected = 0
+        self.failed = 0
+        self.batches = 0
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def submit(self, room_id: int, user_id: int, content: str) -> bool:
+        """Queues one message. Returns False if the queue is full or shutting down."""
+        if self.stopping.is_set():
+            return False
+        row = {
+            "room_id": room_id,
+            "user_id": user_id,
+            "content": content,
+            # Stamped on arrival so batching doesn't reorder the history.
+            "timestamp": datetime.datetime.utcnow(),
+        }
+        try:
+            self.queue.put_nowait(row)
+            return True
+        except queue.Full:
+            return False
+
+    def close(self, timeout: float = 10.0):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+        print(f"Message writer stopped: {self.written} written, {self.rejected} from banned users, {self.failed} failed")
+
+    def _take_batch(self) -> list:
+        deadline = time.monotonic() + MESSAGE_FLUSH_MS / 1000
+        batch = []
+        while len(batch) < MESSAGE_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.stopping.is_set():
+                # Past the deadline, or shutting down: take what is already queued without waiting.
+                try:
+                    batch.append(self.queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                if self.stopping.is_set():
+                    return
+                continue
+            while True:
+                try:
+                    self._flush(batch)
+                    break
+                except OperationalError as e:
+                    # Database unreachable: hold on to the batch and try again.
+                    print(f"Message flush failed, retrying: {e}")
+                    time.sleep(1)
+
+    def _flush(self, batch: list):
+        db = database.SessionLocal()
+        try:
+            pairs = {(row["room_id"], row["user_id"]) for row in batch}
+            banned = set(
+                db.query(models.RoomBan.room_id, models.RoomBan.user_id)
+                .filter(tuple_(models.RoomBan.room_id, models.RoomBan.user_id).in_(pairs))
+                .all()
+            )
+            rows = [row for row in batch if (row["room_id"], row["user_id"]) not in banned]
+            self.rejected += len(batch) - len(rows)
+            if rows:
+                db.execute(insert(models.Message), rows)
+            db.commit()
+            self.written += len(rows)
+            self.batches += 1
+        except OperationalError:
+            db.rollback()
+            raise
+        except Exception as e:
+            db.rollback()
+            print(f"Batched message insert failed ({e}), retrying row by row")
+            self._flush_rows(db, batch)
+        finally:
+            db.close()
+
+    def _flush_rows(self, db, batch: list):
+        # One bad row (e.g. a deleted room) must not take the rest of the batch with it.
+        for row in batch:
+            try:
+                banned = db.query(models.RoomBan.id).filter(
+                    models.RoomBan.room_id == row["room_id"],
+                    models.RoomBan.user_id == row["user_id"]
+                ).first()
+                if banned:
+                    self.rejected += 1
+                    continue
+                db.execute(insert(models.Message), [row])
+                db.commit()
+                self.written += 1
+            except Exception as e:
+                db.rollback()
+                self.failed += 1
+                print(f"Dropping message from user {row['user_id']} in room {row['room_id']}: {e}")
+
+
+message_writer = MessageWriter()
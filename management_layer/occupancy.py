@@ -0,0 +1,145 @@
+import os
+import time
+
+import redis
+
+import database, models
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+RECONCILE_INTERVAL = float(os.getenv("OCCUPANCY_RECONCILE_INTERVAL", 10))
+
+# Every node that currently has occupancy:{node} counters.
+NODES_KEY = "occupancy_nodes"
+# Bucket for callers that don't send x-node-id. It has no heartbeat, so it is never reaped.
+SHARED_NODE = "shared"
+
+# Adjusts one node's count for a room and drops the field once it reaches zero.
+ADJUST_SCRIPT = """
+local n = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+if n <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+end
+redis.call('SADD', KEYS[2], ARGV[3])
+return n
+"""
+
+# Drops a node's counters only if its heartbeat is still missing.
+REAP_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('DEL', KEYS[2])
+    redis.call('SREM', KEYS[3], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+
+class Occupancy:
+    """Live room occupancy kept in Redis instead of the rooms table.
+
+    Each signaling node gets its own hash occupancy:{node} of room -> count,
+    updated with one atomic HINCRBY per join or leave. A room's occupancy is
+    the sum over nodes. When a node's node_alive:{node} heartbeat expires,
+    its hash is dropped, so a crashed node's users stop being counted. The
+    reconciler copies snapshots into rooms.current_participants for anything
+    that still reads the column.
+    """
+
+    def __init__(self):
+        self.redis = redis.Redis.from_url(REDIS_URL)
+        self._adjust = self.redis.register_script(ADJUST_SCRIPT)
+        self._reap = self.redis.register_script(REAP_SCRIPT)
+        self.last_snapshot = None
+
+    def adjust(self, node_id: str, room_id: int, delta: int):
+        try:
+            self._adjust(keys=[f"occupancy:{node_id}", NODES_KEY], args=[room_id, delta, node_id])
+        except Exception as e:
+            print(f"Failed to update occupancy for room {room_id}: {e}")
+
+    def _nodes(self) -> list:
+        return [n.decode() for n in self.redis.smembers(NODES_KEY)]
+
+    def snapshot(self) -> dict:
+        """Returns {room_id: participants} for every occupied room, in two round trips."""
+        pipe = self.redis.pipeline(transaction=False)
+        for node_id in self._nodes():
+            pipe.hgetall(f"occupancy:{node_id}")
+        counts = {}
+        for per_node in pipe.execute():
+            for room_id, n in per_node.items():
+                room_id = int(room_id)
+                counts[room_id] = counts.get(room_id, 0) + int(n)
+        return counts
+
+    def live_counts(self):
+        """Like snapshot(), but returns None if Redis is unreachable so callers can fall back to the table."""
+        try:
+            return self.snapshot()
+        except redis.RedisError as e:
+            print(f"Occupancy unavailable, falling back to database: {e}")
+            return None
+
+    def reap_dead_nodes(self) -> list:
+        dead = []
+        for node_id in self._nodes():
+            if node_id == SHARED_NODE:
+                continue
+            keys = [f"node_alive:{node_id}", f"occupancy:{node_id}", NODES_KEY]
+            if self._reap(keys=keys, args=[node_id]):
+                dead.append(node_id)
+        return dead
+
+    def flush(self, counts: dict):
+        """Writes the rooms whose occupancy changed since the last flush to the rooms table.
+
+        Only rooms this reconciler saw occupied and then empty are marked
+        inactive; a new room nobody has joined yet stays listed.
+        """
+        db = database.SessionLocal()
+        try:
+            previous = self.last_snapshot
+            if previous is None:
+                # First flush since startup: stored counts may be stale. None
+                # marks them as not seen occupied, so they are reset but not deactivated.
+                stale = db.query(models.Room.id).filter(models.Room.current_participants != 0).all()
+                previous = {room_id: None for (room_id,) in stale}
+
+            for room_id, n in counts.items():
+                if previous.get(room_id) != n:
+                    db.query(models.Room).filter(models.Room.id == room_id).update(
+                        {models.Room.current_participants: n, models.Room.is_active: True},
+                        synchronize_session=False,
+                    )
+            emptied = [room_id for room_id in previous if room_id not in counts]
+            if emptied:
+                db.query(models.Room).filter(models.Room.id.in_(emptied)).update(
+                    {models.Room.current_participants: 0},
+                    synchronize_session=False,
+                )
+            deactivated = [room_id for room_id in emptied if previous[room_id] is not None]
+            if deactivated:
+                db.query(models.Room).filter(models.Room.id.in_(deactivated)).update(
+                    {models.Room.is_active: False},
+                    synchronize_session=False,
+                )
+            db.commit()
+            self.last_snapshot = counts
+        finally:
+            db.close()
+
+    def run_reconciler(self):
+        """Runs forever in a background thread."""
+        print(f"Occupancy reconciler running every {RECONCILE_INTERVAL}s")
+        while True:
+            try:
+                dead = self.reap_dead_nodes()
+                if dead:
+                    print(f"Dropped occupancy of dead signaling nodes: {dead}")
+                self.flush(self.snapshot())
+            except Exception as e:
+                print(f"Occupancy reconcile failed: {e}")
+            time.sleep(RECONCILE_INTERVAL)
+
+
+occupancy = Occupancy()
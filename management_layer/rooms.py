@@ -5,8 +5,8 @@ import database, models, schemas
 from auth import oauth2_scheme 
 from jose import JWTError, jwt
 from grpc_server import SECRET_KEY, ALGORITHM
-import redis
-import json
+from occupancy import occupancy
+from bus import notify_ban, kick_user
 
 router = APIRouter(prefix="/rooms", tags=["Rooms"])
 
@@ -48,7 +48,15 @@ def create_room(room: schemas.RoomCreate, current_user: models.User = Depends(ge
 
 @router.get("/", response_model=List[schemas.RoomResponse])
 def list_rooms(db: Session = Depends(database.get_db)):
-    return db.query(models.Room).filter(models.Room.is_active == True).all()
+    rooms = db.query(models.Room).filter(models.Room.is_active == True).all()
+    counts = occupancy.live_counts()
+    if counts is None:
+        return rooms
+
+    # Overlay live counts for the response only; nothing is committed here.
+    for room in rooms:
+        room.current_participants = counts.get(room.id, 0)
+    return rooms
 
 @router.get("/{room_id}", response_model=schemas.RoomResponse)
 def get_room(room_id: int, db: Session = Depends(database.get_db)):
@@ -83,18 +91,8 @@ def block_user_from_room(room_id: int, user_to_block_id: int, reason: str = "Ban
     new_ban = models.RoomBan(user_id=user_to_block_id, room_id=room_id, reason=reason)
     db.add(new_ban)
     db.commit()
-    
-
-    try:
-        r = redis.Redis(host='localhost', port=6379, db=0)
-        kick_message = json.dumps({
-            "type": "system_kick",
-            "user_id": user_to_block_id
-        })
-        r.publish(f"room:{room_id}", kick_message)
-        print(f"Sent output kick for user {user_to_block_id} in room {room_id}")
-    except Exception as e:
-        print(f"Failed to send kick message to Redis: {e}")
+    notify_ban(room_id, user_to_block_id)
+    kick_user(room_id, user_to_block_id)
 
     return {"message": f"User {user_to_block.username} banned from room {room.name}"}
 
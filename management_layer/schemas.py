@@ -27,6 +27,7 @@ class RoomResponse(RoomBase):
     id: int
     is_active: bool
     created_by: int
+    current_participants: int = 0
 
     class Config:
         from_attributes = True
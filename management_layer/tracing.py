@@ -0,0 +1,185 @@
+"""The management layer's half of join-path tracing.
+
+Signaling nodes send a W3C `traceparent` with the gRPC calls they make inside
+a trace. Servicer methods wrapped in @traced record a server span under that
+trace id, and every SQL statement the method runs becomes a child span via
+SQLAlchemy's cursor events. The trace is kept in a ring buffer of the last
+TRACE_BUFFER traces if the caller sampled it or the servicer span took at
+least TRACE_SLOW_MS, and is read back from /stats/traces by trace id.
+
+Calls without a traceparent are not traced at all.
+"""
+import collections
+import contextvars
+import functools
+import os
+import threading
+import time
+
+from sqlalchemy import event
+
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", 500))
+TRACE_BUFFER = int(os.getenv("TRACE_BUFFER", 256))
+# A runaway trace stops growing here instead of holding on to memory.
+MAX_SPANS = 64
+STATEMENT_CHARS = 200
+
+_current = contextvars.ContextVar("trace_span", default=None)
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "start", "end", "attrs")
+
+    def __init__(self, trace, parent_id, name: str, attrs: dict):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.perf_counter()
+        self.end = None
+        self.attrs = attrs
+
+    def to_dict(self, origin: float) -> dict:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "offset_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round((self.end - self.start) * 1000, 3) if self.end is not None else None,
+            "attrs": self.attrs,
+        }
+
+
+class Trace:
+    __slots__ = ("trace_id", "sampled", "started_at", "spans", "done")
+
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.started_at = time.time()
+        self.spans = []
+        self.done = False
+
+    def add(self, parent_id, name: str, attrs: dict):
+        if len(self.spans) >= MAX_SPANS:
+            return None
+        span = Span(self, parent_id, name, attrs)
+        self.spans.append(span)
+        return span
+
+    @property
+    def duration_ms(self) -> float:
+        root = self.spans[0]
+        return (root.end - root.start) * 1000 if root.end is not None else 0.0
+
+    def to_dict(self) -> dict:
+        root = self.spans[0]
+        return {
+            "trace_id": self.trace_id,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration_ms, 3),
+            "sampled": self.sampled,
+            "spans": [span.to_dict(root.start) for span in self.spans],
+        }
+
+
+class Tracer:
+    def __init__(self):
+        # Servicer threads finish traces concurrently.
+        self.lock = threading.Lock()
+        self.buffer = collections.deque(maxlen=TRACE_BUFFER)
+        self.started = 0
+        self.kept_sampled = 0
+        self.kept_slow = 0
+
+    def finish(self, trace: Trace):
+        trace.done = True
+        with self.lock:
+            self.started += 1
+            if trace.sampled:
+                self.kept_sampled += 1
+            elif TRACE_SLOW_MS > 0 and trace.duration_ms >= TRACE_SLOW_MS:
+                self.kept_slow += 1
+            else:
+                return
+            self.buffer.append(trace)
+
+    def dump(self, min_ms: float = 0, limit: int = 50, trace_id: str = None) -> dict:
+        with self.lock:
+            buffered = list(self.buffer)
+        traces = []
+        for trace in reversed(buffered):
+            if trace_id is not None and trace.trace_id != trace_id:
+                continue
+            if trace.duration_ms < min_ms:
+                continue
+            traces.append(trace.to_dict())
+            if len(traces) >= limit:
+                break
+        return {"stats": self.stats(), "traces": traces}
+
+    def stats(self) -> dict:
+        return {
+            "slow_ms": TRACE_SLOW_MS,
+            "started": self.started,
+            "kept_sampled": self.kept_sampled,
+            "kept_slow": self.kept_slow,
+            "buffered": len(self.buffer),
+        }
+
+
+tracer = Tracer()
+
+
+def _traceparent(context):
+    """(trace_id, parent_span_id, sampled) from the call's metadata, or None."""
+    for key, value in context.invocation_metadata():
+        if key == "traceparent":
+            parts = value.split("-")
+            if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+                return parts[1], parts[2], parts[3] == "01"
+            return None
+    return None
+
+
+def traced(method):
+    """Records a servicer method as a span of the caller's trace."""
+    name = f"ManagementService.{method.__name__}"
+
+    @functools.wraps(method)
+    def wrapper(self, request, context):
+        parent = _traceparent(context)
+        if parent is None:
+            return method(self, request, context)
+        trace_id, parent_id, sampled = parent
+        trace = Trace(trace_id, sampled)
+        span = trace.add(parent_id, name, {})
+        token = _current.set(span)
+        try:
+            return method(self, request, context)
+        except Exception as e:
+            span.attrs["error"] = type(e).__name__
+            raise
+        finally:
+            span.end = time.perf_counter()
+            _current.reset(token)
+            tracer.finish(trace)
+
+    return wrapper
+
+
+def instrument_engine(engine):
+    """Records each SQL statement run inside a traced servicer call as a child span."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        parent = _current.get()
+        if parent is None or parent.trace.done or context is None:
+            return
+        context._trace_span = parent.trace.add(parent.span_id, "sql", {"statement": statement[:STATEMENT_CHARS]})
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        span = getattr(context, "_trace_span", None)
+        if span is not None:
+            span.end = time.perf_counter()
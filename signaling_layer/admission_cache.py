@@ -0,0 +1,85 @@
+import collections
+import time
+
+import config
+
+# Reasons that describe the management layer's health rather than the
+# user's admission, and so must never be cached.
+UNCACHEABLE_REASONS = {"Internal Error", "Service Unavailable"}
+
+
+class AdmissionCache:
+    """TTL'd, size-bounded LRU of ValidateJoin results keyed by (room_id, user_id).
+
+    Missing rooms are cached separately, for a shorter time and under the
+    same size bound, so a burst of joins to a bogus room costs one lookup.
+    Every ban invalidation bumps `epoch`; a result is only stored if no
+    invalidation happened while its RPC was in flight, so a ban can never be
+    overwritten by an older answer. If invalidations may have been missed
+    (the control channel was down), clear() drops everything.
+    """
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.missing_rooms = collections.OrderedDict()
+        self.epoch = 0
+        self.clears = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, room_id: int, user_id: int):
+        now = time.monotonic()
+        expires = self.missing_rooms.get(room_id)
+        if expires is not None:
+            if expires > now:
+                self.hits += 1
+                return False, "Room not found"
+            del self.missing_rooms[room_id]
+
+        key = (room_id, user_id)
+        entry = self.entries.get(key)
+        if entry is not None:
+            allowed, reason, expires = entry
+            if expires > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return allowed, reason
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, room_id: int, user_id: int, allowed: bool, reason: str, epoch: int):
+        if epoch != self.epoch or reason in UNCACHEABLE_REASONS:
+            return
+        now = time.monotonic()
+        if reason == "Room not found":
+            self.missing_rooms[room_id] = now + config.ADMISSION_NEGATIVE_TTL
+            self.missing_rooms.move_to_end(room_id)
+            while len(self.missing_rooms) > config.ADMISSION_CACHE_SIZE:
+                self.missing_rooms.popitem(last=False)
+            return
+
+        self.entries[(room_id, user_id)] = (allowed, reason, now + config.ADMISSION_CACHE_TTL)
+        self.entries.move_to_end((room_id, user_id))
+        while len(self.entries) > config.ADMISSION_CACHE_SIZE:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, room_id: int, user_id: int):
+        self.epoch += 1
+        self.entries.pop((room_id, user_id), None)
+
+    def clear(self):
+        self.epoch += 1
+        self.entries.clear()
+        self.missing_rooms.clear()
+        self.clears += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "missing_rooms": len(self.missing_rooms),
+            "hits": self.hits,
+            "misses": self.misses,
+            "clears": self.clears,
+        }
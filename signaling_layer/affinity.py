@@ -0,0 +1,173 @@
+import bisect
+import collections
+import hashlib
+import json
+import math
+
+import config
+from redis_manager import redis_manager
+
+NODES_KEY = "signaling_nodes"
+ROOM_NODE_KEY = "room_node"
+
+# Deletes a room's placement only if it still points at the given node.
+RELEASE_ROOM_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+
+def _hash(key: str) -> int:
+    # crc32 clusters badly on keys like "node#1", "node#2"; blake2b spreads them evenly.
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class AffinityRouter:
+    """Places rooms on signaling nodes so a room's members share one node.
+
+    Nodes advertise their URL, connection count and drain state in their
+    node_alive:{node} heartbeat. A new room is hashed onto a consistent-hash
+    ring (AFFINITY_VNODES points per node) and walks clockwise past any node
+    already above AFFINITY_LOAD_FACTOR times the average load, so hot spots
+    spill to the next node instead of piling up. The choice is recorded in
+    the room_node hash and reused until the room empties or its node dies.
+
+    Nodes that advertise the same URL (serve.py workers without their own
+    ports) can't be addressed individually, so they are left off the ring;
+    if no node is addressable, rooms aren't placed at all.
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self._release_room = self.redis.register_script(RELEASE_ROOM_SCRIPT)
+        self._ring_nodes = None
+        self._ring = []
+        self._ring_keys = []
+
+        self.placements = 0
+        self.sticky = 0
+        self.spilled = 0
+        self.unplaced = 0
+        # Messages delivered here, split by whether they came from this node.
+        self.local_origin = 0
+        self.remote_origin = 0
+        # Room messages sent from here that did / did not need the bus.
+        self.bus_publishes = 0
+        self.bus_skipped = 0
+
+    async def live_nodes(self) -> dict:
+        """Returns {node_id: status} for every node with an unexpired heartbeat."""
+        node_ids = [n.decode() for n in await self.redis.smembers(NODES_KEY)]
+        if not node_ids:
+            return {}
+        values = await self.redis.mget([f"node_alive:{n}" for n in node_ids])
+        nodes, dead = {}, []
+        for node_id, value in zip(node_ids, values):
+            if value is None:
+                dead.append(node_id)
+                continue
+            try:
+                nodes[node_id] = json.loads(value)
+            except ValueError:
+                continue
+        if dead:
+            await self.redis.srem(NODES_KEY, *dead)
+        return nodes
+
+    def _ring_for(self, node_ids: frozenset):
+        if node_ids != self._ring_nodes:
+            points = sorted(
+                (_hash(f"{node_id}#{i}"), node_id)
+                for node_id in node_ids
+                for i in range(config.AFFINITY_VNODES)
+            )
+            self._ring = [node_id for _, node_id in points]
+            self._ring_keys = [h for h, _ in points]
+            self._ring_nodes = node_ids
+        return self._ring, self._ring_keys
+
+    def choose(self, room_id: int, nodes: dict) -> str:
+        """Consistent hashing with bounded load over the nodes that are taking joins."""
+        open_nodes = {n: s for n, s in nodes.items() if not s.get("draining")}
+        if not open_nodes:
+            return None
+        ring, keys = self._ring_for(frozenset(open_nodes))
+        total = sum(s.get("connections", 0) for s in open_nodes.values())
+        capacity = math.ceil(config.AFFINITY_LOAD_FACTOR * (total + 1) / len(open_nodes))
+
+        start = bisect.bisect(keys, _hash(f"room:{room_id}"))
+        seen = set()
+        for i in range(len(ring)):
+            node_id = ring[(start + i) % len(ring)]
+            if node_id in seen:
+                continue
+            if open_nodes[node_id].get("connections", 0) < capacity:
+                if seen:
+                    self.spilled += 1
+                return node_id
+            seen.add(node_id)
+        return ring[start % len(ring)]
+
+    @staticmethod
+    def addressable(nodes: dict) -> dict:
+        """The nodes whose advertised URL reaches only them."""
+        urls = collections.Counter(status.get("url") for status in nodes.values())
+        return {n: s for n, s in nodes.items() if s.get("url") and urls[s["url"]] == 1}
+
+    async def place(self, room_id: int):
+        """Returns (node_id, url) for the node this room's members should connect to.
+
+        (None, None) means no node can be addressed directly; the caller
+        hands out its own URL and nothing is recorded.
+        """
+        nodes = self.addressable(await self.live_nodes())
+        current = await self.redis.hget(ROOM_NODE_KEY, room_id)
+        if current is not None:
+            current = current.decode()
+            status = nodes.get(current)
+            if status and not status.get("draining"):
+                self.sticky += 1
+                return current, status["url"]
+            # Its node died or is draining: forget it so the room is placed afresh.
+            await self._release_room(keys=[ROOM_NODE_KEY], args=[room_id, current])
+
+        node_id = self.choose(room_id, nodes)
+        if node_id is None:
+            self.unplaced += 1
+            return None, None
+        if not await self.redis.hsetnx(ROOM_NODE_KEY, room_id, node_id):
+            # Someone placed it concurrently; go with theirs.
+            winner = (await self.redis.hget(ROOM_NODE_KEY, room_id) or b"").decode()
+            if winner in nodes:
+                node_id = winner
+        self.placements += 1
+        return node_id, nodes[node_id]["url"]
+
+    async def release_room(self, room_id: int):
+        """Called when this node's last member of a room leaves."""
+        await self._release_room(keys=[ROOM_NODE_KEY], args=[room_id, config.NODE_ID])
+
+    def record_local(self):
+        self.local_origin += 1
+
+    def record_remote(self):
+        self.remote_origin += 1
+
+    def stats(self) -> dict:
+        delivered = self.local_origin + self.remote_origin
+        return {
+            "placements": self.placements,
+            "sticky": self.sticky,
+            "spilled": self.spilled,
+            "unplaced": self.unplaced,
+            "local_origin": self.local_origin,
+            "remote_origin": self.remote_origin,
+            "cross_node_ratio": round(self.remote_origin / delivered, 4) if delivered else 0.0,
+            "bus_publishes": self.bus_publishes,
+            "bus_skipped": self.bus_skipped,
+        }
+
+
+router = AffinityRouter(redis_manager.redis)
@@ -0,0 +1,66 @@
+"""Room bus benchmark: pub/sub vs Redis Streams, against a local Redis.
+
+Publishes messages to one room from the same process that consumes them and
+reports delivered throughput and publish-to-callback latency percentiles.
+
+    REDIS_URL=redis://127.0.0.1:6379 python bench_bus.py [messages] [concurrency]
+"""
+import asyncio
+import json
+import sys
+import time
+
+import envelope
+from redis_manager import RedisManager, StreamsRedisManager
+
+ROOM_ID = 987654
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+async def run(manager_cls, n, concurrency):
+    manager = manager_cls()
+    latencies = []
+    done = asyncio.Event()
+
+    async def on_message(channel, data):
+        payload = envelope.unpack(data)[-1]
+        latencies.append(time.perf_counter() - json.loads(payload)["t"])
+        if len(latencies) >= n:
+            done.set()
+
+    await manager.set_callback(on_message)
+    await manager.connect()
+    await manager.subscribe(ROOM_ID)
+    await asyncio.sleep(0.5)
+
+    start = time.perf_counter()
+    for i in range(0, n, concurrency):
+        await asyncio.gather(*(
+            manager.publish(ROOM_ID, {"type": "chat", "user_id": 1, "content": "x" * 64, "t": time.perf_counter()})
+            for _ in range(min(concurrency, n - i))
+        ))
+    try:
+        await asyncio.wait_for(done.wait(), timeout=10)
+    except asyncio.TimeoutError:
+        print("got", len(latencies))
+    elapsed = time.perf_counter() - start
+
+    await manager.unsubscribe(ROOM_ID)
+    await manager.redis.delete(f"stream:room:{ROOM_ID}")
+    latencies.sort()
+    ms = lambda p: percentile(latencies, p) * 1000
+    print(f"{manager_cls.__name__:<20} {n / elapsed:>10,.0f} msg/s   p50 {ms(0.5):6.2f}ms   p99 {ms(0.99):6.2f}ms   p999 {ms(0.999):6.2f}ms")
+
+
+async def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    for manager_cls in (RedisManager, StreamsRedisManager):
+        await run(manager_cls, n, concurrency)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,77 @@
+"""Failover-to-delivery-resumed time for the pub/sub listener.
+
+Publishes a message to one room every PUBLISH_INTERVAL, knocks the listener
+off Redis, and reports how long it takes until messages are delivered
+again, plus whether a gap event was raised.
+
+By default the listener connections are killed with CLIENT KILL TYPE pubsub.
+Pass a shell command to restart a real local Redis instead, e.g.
+
+    python bench_failover.py "docker restart redis"
+"""
+import asyncio
+import subprocess
+import sys
+import time
+
+from redis_manager import RedisManager
+
+ROOM_ID = 987655
+PUBLISH_INTERVAL = 0.01
+
+
+async def main():
+    restart_cmd = sys.argv[1] if len(sys.argv) > 1 else None
+    manager = RedisManager()
+    received = []
+    gaps = []
+
+    async def on_message(channel, data):
+        received.append(time.monotonic())
+
+    async def on_gap(room_ids):
+        gaps.append((time.monotonic(), room_ids))
+
+    await manager.set_callback(on_message)
+    await manager.set_gap_callback(on_gap)
+    await manager.connect()
+    await manager.subscribe(ROOM_ID)
+
+    async def publisher():
+        while True:
+            try:
+                await manager.publish(ROOM_ID, {"type": "chat", "user_id": 1, "content": "tick"})
+            except Exception:
+                pass
+            await asyncio.sleep(PUBLISH_INTERVAL)
+
+    pub_task = asyncio.create_task(publisher())
+    await asyncio.sleep(1)
+
+    before = len(received)
+    failed_at = time.monotonic()
+    if restart_cmd:
+        subprocess.run(restart_cmd, shell=True, check=True)
+    else:
+        await manager.redis.client_kill_filter(_type="pubsub")
+
+    deadline = failed_at + 30
+    while time.monotonic() < deadline:
+        resumed = [t for t in received[before:] if t > failed_at]
+        if gaps and resumed and resumed[-1] > gaps[0][0]:
+            break
+        await asyncio.sleep(0.005)
+    pub_task.cancel()
+
+    resumed = [t for t in received[before:] if t > (gaps[0][0] if gaps else failed_at)]
+    if not resumed:
+        print("delivery did not resume within 30s")
+        return
+    print(f"gap events      : {len(gaps)} (rooms {gaps[0][1] if gaps else []})")
+    print(f"resubscribed in : {gaps[0][0] - failed_at:.3f}s" if gaps else "resubscribed in : n/a")
+    print(f"delivery resumed: {resumed[0] - failed_at:.3f}s after failover")
+    print(f"shards          : {manager.get_shard_stats()}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
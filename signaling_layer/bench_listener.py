@@ -0,0 +1,61 @@
+"""Listener routing throughput: legacy json.loads path vs routing envelope.
+
+Measures only the per-message routing decision made in handle_redis_message,
+on one core, with a chat/SDP/candidate mix representative of call setup.
+
+    python bench_listener.py [messages]
+"""
+import json
+import sys
+import time
+
+import codec
+import envelope
+
+SDP = "v=0\r\no=- 4611731400430051336 2 IN IP4 127.0.0.1\r\n" + "a=candidate:1 1 udp 2122260223 10.0.0.1 54321 typ host\r\n" * 40
+
+
+def sample_messages():
+    messages = [
+        {"type": "chat", "user_id": 7, "content": "hello everyone"},
+        {"type": "offer", "user_id": 7, "target_id": 9, "data": {"type": "offer", "sdp": SDP}},
+        {"type": "candidate", "user_id": 7, "target_id": 9, "data": {"candidate": "candidate:1 1 udp 2122260223 10.0.0.1 54321 typ host", "sdpMid": "0", "sdpMLineIndex": 0}},
+        {"type": "user_joined", "user_id": 7},
+    ]
+    return [("room:42", m) for m in messages]
+
+
+def route_legacy(channel, data):
+    room_id = int(channel.split(":")[1])
+    message_data = json.loads(data)
+    return message_data.get("type"), room_id, data
+
+
+def route_envelope(channel, data):
+    msg_type, _origin, room_id, target_id, _codec, payload = envelope.unpack(data)
+    return msg_type, room_id, payload
+
+
+def run(route, encoded, n):
+    start = time.perf_counter()
+    for i in range(n):
+        channel, data = encoded[i % len(encoded)]
+        route(channel, data)
+    elapsed = time.perf_counter() - start
+    return n / elapsed
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    samples = sample_messages()
+    legacy = [(ch, json.dumps(m).encode()) for ch, m in samples]
+    enveloped = [(ch, envelope.pack(m["type"], "node", 42, m.get("target_id"), codec.JSON, json.dumps(m).encode())) for ch, m in samples]
+
+    before = run(route_legacy, legacy, n)
+    after = run(route_envelope, enveloped, n)
+    print(f"legacy json.loads : {before:>12,.0f} msg/s")
+    print(f"envelope          : {after:>12,.0f} msg/s  ({after / before:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
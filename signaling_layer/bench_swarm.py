@@ -0,0 +1,518 @@
+"""WebSocket swarm benchmark for the signaling layer, run fully locally.
+
+Starts an in-process stub of ManagementService, which admits every join and
+acknowledges every call without a database. Then starts a signaling node
+(serve.py) pointed at the stub and at the local Redis in REDIS_URL. It
+opens --clients sockets spread over rooms whose sizes are drawn from
+--room-sizes and runs a scripted workload:
+
+  join       every socket joins; latency is connect until existing_users
+  signaling  room members pair off: offer -> answer -> --candidates trickle
+             candidates each way; latency is send until the peer receives it
+  chat       every socket sends --chat chat lines; latency is measured at
+             every receiver in the room (fan-out)
+
+For each phase it reports latency p50/p99/p999 and messages delivered per
+second. It also reports the node's resident memory per socket. Rate limits
+are switched off on the spawned node so the limiter doesn't shape the
+result. Pass --json to save the numbers for comparison between builds.
+
+    python bench_swarm.py --clients 2000 --room-sizes 2:50,8:35,50:15
+    python bench_swarm.py --workers 4 --clients 5000 --json before.json
+
+--url benchmarks a node that is already running instead. That node then
+talks to whatever ManagementService it was started with, and --pid
+(the node's or launcher's pid) enables the memory figure.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import signal
+import subprocess
+import sys
+import time
+import uuid
+
+import grpc
+import websockets
+
+import service_pb2
+import service_pb2_grpc
+
+# Far above real room ids, so bench traffic never lands in a real room.
+ROOM_ID_BASE = 900_000_000
+# A realistic SDP body: a few KB of highly repetitive text.
+SDP = "v=0\r\no=- 0 0 IN IP4 127.0.0.1\r\ns=-\r\nt=0 0\r\n" + "".join(
+    f"a=candidate:{i} 1 udp 2122260223 192.168.1.{i % 250} {50000 + i} typ host generation 0\r\n"
+    f"a=rtpmap:{96 + i % 30} VP8/90000\r\n"
+    for i in range(40)
+)
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def summarize(latencies: list) -> dict:
+    if not latencies:
+        return {"count": 0}
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+        "p999_ms": round(percentile(values, 0.999) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3),
+    }
+
+
+def parse_room_sizes(spec: str) -> list:
+    """"2:50,8:35,50:15" -> [(2, 50.0), (8, 35.0), (50, 15.0)] as (size, weight)."""
+    sizes = []
+    for item in spec.split(","):
+        size, _, weight = item.partition(":")
+        sizes.append((int(size), float(weight or 1)))
+    return sizes
+
+
+def build_rooms(clients: int, sizes: list, seed: int) -> list:
+    """Draws room sizes until every client has a room; returns a list of member counts."""
+    rng = random.Random(seed)
+    rooms = []
+    remaining = clients
+    while remaining > 0:
+        size = min(rng.choices([s for s, _ in sizes], weights=[w for _, w in sizes])[0], remaining)
+        rooms.append(size)
+        remaining -= size
+    return rooms
+
+
+def process_tree(pid: int) -> list:
+    """The pid and all its descendants, from /proc."""
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        return [pid]
+    return [pid] + [p for child in children for p in process_tree(child)]
+
+
+def rss_bytes(pid: int) -> int:
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                total += next((int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:")), 0)
+        except OSError:
+            pass
+    return total
+
+
+def cpu_seconds(pid: int) -> float:
+    """User + system CPU time of a process tree."""
+    ticks = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                # Fields after the parenthesised command name; utime and stime are 14 and 15.
+                fields = f.read().rsplit(")", 1)[1].split()
+            ticks += int(fields[11]) + int(fields[12])
+        except (OSError, IndexError, ValueError):
+            pass
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+class CpuMeter:
+    """CPU use of the bench itself and of the node over one phase, as a fraction of one core."""
+
+    def __init__(self, node_pid):
+        self.node_pid = node_pid
+        self.wall = time.perf_counter()
+        self.own = self._own()
+        self.node = cpu_seconds(node_pid) if node_pid else 0.0
+
+    @staticmethod
+    def _own():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    def read(self) -> dict:
+        wall = time.perf_counter() - self.wall
+        return {
+            "bench_cpu": round((self._own() - self.own) / wall, 2),
+            "node_cpu": round((cpu_seconds(self.node_pid) - self.node) / wall, 2) if self.node_pid else None,
+        }
+
+
+class StubManagementService(service_pb2_grpc.ManagementServiceServicer):
+    """Admits every join and acknowledges every call, so the bench measures the signaling node alone."""
+
+    def __init__(self):
+        self.calls = {}
+
+    def _count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    async def ValidateJoin(self, request, context):
+        self._count("ValidateJoin")
+        return service_pb2.JoinResponse(allowed=True, reason="OK")
+
+    async def UserJoined(self, request, context):
+        self._count("UserJoined")
+        return service_pb2.JoinResponse(allowed=True, reason="OK")
+
+    async def UserLeft(self, request, context):
+        self._count("UserLeft")
+        return service_pb2.JoinResponse(allowed=True, reason="OK")
+
+    async def StoreMessage(self, request, context):
+        self._count("StoreMessage")
+        return service_pb2.MessageResponse(success=True)
+
+
+class Swarm:
+    """All simulated clients, plus what they have measured so far."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.clients = []
+        self.latencies = {"join": [], "offer": [], "answer": [], "candidate": [], "chat": []}
+        self.received = {kind: 0 for kind in self.latencies}
+        self.last_received = 0.0
+        self.throttled = 0
+        self.errors = 0
+        self.send_failures = 0
+        # close reason -> sockets closed before they finished joining
+        self.rejected = {}
+
+    def alive_by_room(self) -> dict:
+        rooms = {}
+        for client in self.clients:
+            if client.alive:
+                rooms.setdefault(client.room_id, []).append(client)
+        return rooms
+
+    def record(self, kind: str, sent_at: float):
+        now = time.perf_counter()
+        self.latencies[kind].append(now - sent_at)
+        self.received[kind] += 1
+        self.last_received = now
+
+    async def wait_for(self, kind: str, expected: int, timeout: float):
+        deadline = time.monotonic() + timeout
+        while self.received[kind] < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+
+class Client:
+    def __init__(self, swarm: Swarm, room_id: int, user_id: int):
+        self.swarm = swarm
+        self.room_id = room_id
+        self.user_id = user_id
+        self.ws = None
+        self.joined = asyncio.Event()
+        self.reader = None
+        # True from existing_users until the socket closes.
+        self.alive = False
+
+    async def join(self):
+        started = time.perf_counter()
+        self.ws = await websockets.connect(
+            f"{self.swarm.url}/ws/{self.room_id}/{self.user_id}?caps=candidates,heartbeat",
+            max_queue=None,
+        )
+        self.reader = asyncio.create_task(self._read(started))
+        await self.joined.wait()
+
+    async def send(self, message: dict):
+        try:
+            await self.ws.send(json.dumps(message))
+        except websockets.ConnectionClosed:
+            self.swarm.send_failures += 1
+
+    async def _read(self, join_started: float):
+        swarm = self.swarm
+        try:
+            async for frame in self.ws:
+                message = json.loads(frame)
+                msg_type = message.get("type")
+                if msg_type == "existing_users":
+                    swarm.record("join", join_started)
+                    self.alive = True
+                    self.joined.set()
+                elif msg_type == "chat":
+                    swarm.record("chat", float(message["content"]))
+                elif msg_type == "offer":
+                    swarm.record("offer", message["data"]["ts"])
+                    await self.send({
+                        "type": "answer",
+                        "target_id": message["user_id"],
+                        "data": {"type": "answer", "sdp": SDP, "ts": time.perf_counter()},
+                    })
+                elif msg_type == "answer":
+                    swarm.record("answer", message["data"]["ts"])
+                elif msg_type == "candidate":
+                    swarm.record("candidate", message["data"]["ts"])
+                elif msg_type == "candidates":
+                    for candidate in message["data"]:
+                        swarm.record("candidate", candidate["ts"])
+                elif msg_type == "ping":
+                    await self.send({"type": "pong"})
+                elif msg_type == "throttled":
+                    swarm.throttled += 1
+        except websockets.ConnectionClosed:
+            pass
+        except Exception as e:
+            swarm.errors += 1
+            print(f"Client {self.user_id} reader failed: {e!r}")
+        finally:
+            if not self.joined.is_set():
+                close = self.ws.close_rcvd
+                reason = f"{close.code} {close.reason}" if close else "no close frame"
+                swarm.rejected[reason] = swarm.rejected.get(reason, 0) + 1
+            self.alive = False
+            self.joined.set()
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self.reader is not None:
+            await self.reader
+
+
+async def run_join(swarm: Swarm, rooms: list, concurrency: int, seed: int):
+    user_id = 1
+    for index, size in enumerate(rooms):
+        for _ in range(size):
+            swarm.clients.append(Client(swarm, ROOM_ID_BASE + seed * 100_000 + index, user_id))
+            user_id += 1
+
+    gate = asyncio.Semaphore(concurrency)
+
+    async def join(client):
+        async with gate:
+            try:
+                await client.join()
+            except Exception as e:
+                swarm.errors += 1
+                print(f"Client {client.user_id} failed to join: {e!r}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(join(client) for client in swarm.clients))
+    return time.perf_counter() - start
+
+
+async def run_signaling(swarm: Swarm, candidates: int, timeout: float):
+    pairs = [
+        (members[i], members[i + 1])
+        for members in swarm.alive_by_room().values()
+        for i in range(0, len(members) - 1, 2)
+    ]
+    if not pairs:
+        return 0.0, 0
+
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        a.send({"type": "offer", "target_id": b.user_id, "data": {"type": "offer", "sdp": SDP, "ts": time.perf_counter()}})
+        for a, b in pairs
+    ))
+    await swarm.wait_for("answer", len(pairs), timeout)
+
+    async def trickle(sender, target):
+        for i in range(candidates):
+            await sender.send({
+                "type": "candidate",
+                "target_id": target.user_id,
+                "data": {"candidate": f"candidate:{i} 1 udp 2122260223 10.0.0.1 {50000 + i} typ host", "ts": time.perf_counter()},
+            })
+
+    await asyncio.gather(*(trickle(a, b) for a, b in pairs), *(trickle(b, a) for a, b in pairs))
+    await swarm.wait_for("candidate", len(pairs) * 2 * candidates, timeout)
+    delivered = swarm.received["offer"] + swarm.received["answer"] + swarm.received["candidate"]
+    return swarm.last_received - start, delivered
+
+
+async def run_chat(swarm: Swarm, messages: int, interval: float, timeout: float):
+    async def chatter(client):
+        # Spread the senders out so the phase is a steady load, not one burst.
+        await asyncio.sleep(random.random() * interval)
+        for _ in range(messages):
+            await client.send({"type": "chat", "content": repr(time.perf_counter())})
+            await asyncio.sleep(interval)
+
+    # Chat goes to every member of the room, the sender included.
+    rooms = swarm.alive_by_room()
+    expected = sum(len(members) ** 2 for members in rooms.values()) * messages
+    start = time.perf_counter()
+    await asyncio.gather(*(chatter(client) for members in rooms.values() for client in members))
+    await swarm.wait_for("chat", expected, timeout)
+    return swarm.last_received - start, swarm.received["chat"], expected
+
+
+async def wait_for_port(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise SystemExit(f"Signaling node did not come up on port {port}")
+
+
+def start_node(args, stub_port: int) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        SIGNALING_HOST="127.0.0.1",
+        SIGNALING_PORT=str(args.port),
+        SIGNALING_WORKERS=str(args.workers),
+        SIGNALING_NODE_ID=f"bench-{uuid.uuid4().hex[:6]}",
+        MANAGEMENT_HOST="127.0.0.1",
+        MANAGEMENT_PORT=str(stub_port),
+        RATE_LIMITS="",
+        ROOM_RATE_LIMITS="",
+        DRAIN_SPREAD="0.5",
+        DRAIN_REJOIN_GRACE="0",
+    )
+    return subprocess.Popen(
+        [sys.executable, "serve.py"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        stdout=subprocess.DEVNULL if not args.node_logs else None,
+        stderr=subprocess.STDOUT if not args.node_logs else None,
+    )
+
+
+def print_report(report: dict):
+    print(f"clients {report['clients']} in {report['rooms']} rooms, node RSS {report['rss_per_socket_bytes'] or 'n/a'} bytes/socket")
+    print(f"{'phase':<10} {'count':>8} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9} {'max ms':>9} {'msgs/s':>8} {'node cpu':>9} {'bench cpu':>9}")
+    bench_bound, machine_bound = [], []
+    for name, phase in report["phases"].items():
+        if phase["bench_cpu"] >= 0.9:
+            bench_bound.append(name)
+        elif phase["bench_cpu"] + (phase["node_cpu"] or 0) >= 0.8 * report["cpus"]:
+            machine_bound.append(name)
+        for kind, latency in phase["latency"].items():
+            if not latency["count"]:
+                continue
+            print(
+                f"{kind:<10} {latency['count']:>8} {latency['p50_ms']:>9} {latency['p99_ms']:>9} "
+                f"{latency['p999_ms']:>9} {latency['max_ms']:>9} {phase['msgs_per_s']:>8} "
+                f"{phase['node_cpu'] if phase['node_cpu'] is not None else 'n/a':>9} {phase['bench_cpu']:>9}"
+            )
+    if bench_bound:
+        print(f"Warning: the bench used a full core during {', '.join(bench_bound)}; those numbers are bounded by the load generator")
+    if machine_bound:
+        print(f"Warning: bench and node used all {report['cpus']} CPUs during {', '.join(machine_bound)}; those numbers are bounded by this machine")
+    if report["chat_missing"]:
+        print(f"chat deliveries missing: {report['chat_missing']}")
+    if report["rejected"]:
+        print(f"joins rejected: {report['rejected']}")
+    print(f"throttled notices {report['throttled']}, client errors {report['errors']}, failed sends {report['send_failures']}, stub calls {report['stub_calls']}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--room-sizes", default="2:50,8:35,50:15", help="size:weight,... distribution of room sizes")
+    parser.add_argument("--candidates", type=int, default=8, help="trickle candidates per peer in the signaling phase")
+    parser.add_argument("--chat", type=int, default=5, help="chat messages per client")
+    parser.add_argument("--chat-interval", type=float, default=1.0, help="seconds between one client's chat messages")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=30, help="per-phase wait for deliveries")
+    parser.add_argument("--workers", type=int, default=1, help="serve.py workers on the spawned node")
+    parser.add_argument("--port", type=int, default=18801)
+    parser.add_argument("--url", help="benchmark an already running node instead of spawning one")
+    parser.add_argument("--pid", type=int, help="pid of the --url node, for memory per socket")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--node-logs", action="store_true")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if args.clients + 100 > hard:
+        print(f"Warning: the open file limit is {hard}, below what {args.clients} clients need")
+
+    stub = StubManagementService()
+    grpc_server = grpc.aio.server()
+    service_pb2_grpc.add_ManagementServiceServicer_to_server(stub, grpc_server)
+    stub_port = grpc_server.add_insecure_port("127.0.0.1:0")
+    await grpc_server.start()
+
+    node = None
+    if args.url:
+        url, pid = args.url.rstrip("/"), args.pid
+    else:
+        node = start_node(args, stub_port)
+        url, pid = f"ws://127.0.0.1:{args.port}", node.pid
+        await wait_for_port(args.port)
+        await asyncio.sleep(1)
+
+    swarm = Swarm(url)
+    rooms = build_rooms(args.clients, parse_room_sizes(args.room_sizes), args.seed)
+    report = {
+        "clients": args.clients,
+        "rooms": len(rooms),
+        "room_sizes": args.room_sizes,
+        "workers": args.workers,
+        "cpus": len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count(),
+        "phases": {},
+    }
+    try:
+        rss_before = rss_bytes(pid) if pid else 0
+        cpu = CpuMeter(pid)
+        elapsed = await run_join(swarm, rooms, args.connect_concurrency, args.seed)
+        report["phases"]["join"] = {
+            "latency": {"join": summarize(swarm.latencies["join"])},
+            "msgs_per_s": round(len(swarm.latencies["join"]) / elapsed),
+            **cpu.read(),
+        }
+        await asyncio.sleep(1)
+        rss_after = rss_bytes(pid) if pid else 0
+        joined = len(swarm.latencies["join"])
+        report["rss_per_socket_bytes"] = round((rss_after - rss_before) / joined) if pid and joined else None
+
+        cpu = CpuMeter(pid)
+        elapsed, delivered = await run_signaling(swarm, args.candidates, args.timeout)
+        report["phases"]["signaling"] = {
+            "latency": {kind: summarize(swarm.latencies[kind]) for kind in ("offer", "answer", "candidate")},
+            "msgs_per_s": round(delivered / elapsed) if elapsed else 0,
+            **cpu.read(),
+        }
+
+        cpu = CpuMeter(pid)
+        elapsed, delivered, expected = await run_chat(swarm, args.chat, args.chat_interval, args.timeout)
+        report["phases"]["chat"] = {
+            "latency": {"chat": summarize(swarm.latencies["chat"])},
+            "msgs_per_s": round(delivered / elapsed) if elapsed else 0,
+            **cpu.read(),
+        }
+        report["chat_missing"] = expected - delivered
+    finally:
+        await asyncio.gather(*(client.close() for client in swarm.clients), return_exceptions=True)
+        if node is not None:
+            node.send_signal(signal.SIGTERM)
+            try:
+                node.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                node.kill()
+        await grpc_server.stop(None)
+
+    report["throttled"] = swarm.throttled
+    report["errors"] = swarm.errors
+    report["rejected"] = swarm.rejected
+    report["send_failures"] = swarm.send_failures
+    report["stub_calls"] = stub.calls
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
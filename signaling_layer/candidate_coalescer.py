@@ -0,0 +1,52 @@
+import asyncio
+from typing import Dict, List, Tuple
+
+import config
+
+# Clients advertise this in the ?caps= query string to receive batched candidates.
+CAP_CANDIDATES = "candidates"
+
+
+class CandidateCoalescer:
+    """Batches trickle-ICE candidates per (room, sender, target) for a short window.
+
+    The first candidate for a pair opens a CANDIDATE_WINDOW_MS window; everything
+    that arrives for the same pair before it closes (or until CANDIDATE_BATCH_MAX
+    is reached) goes out as a single `candidates` message via flush_callback.
+    """
+
+    def __init__(self):
+        self.pending: Dict[Tuple[int, int, int], List] = {}
+        self.timers: Dict[Tuple[int, int, int], asyncio.TimerHandle] = {}
+        self.flush_callback = None
+        self._flush_tasks = set()
+
+    def set_callback(self, callback):
+        self.flush_callback = callback
+
+    def add(self, room_id: int, sender_id: int, target_id: int, candidate):
+        key = (room_id, sender_id, target_id)
+        batch = self.pending.setdefault(key, [])
+        batch.append(candidate)
+
+        if len(batch) >= config.CANDIDATE_BATCH_MAX:
+            self._flush(key)
+        elif key not in self.timers:
+            loop = asyncio.get_running_loop()
+            self.timers[key] = loop.call_later(config.CANDIDATE_WINDOW_MS / 1000, self._flush, key)
+
+    def _flush(self, key):
+        timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        batch = self.pending.pop(key, None)
+        if not batch or not self.flush_callback:
+            return
+
+        room_id, sender_id, target_id = key
+        task = asyncio.create_task(self.flush_callback(room_id, sender_id, target_id, batch))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+
+coalescer = CandidateCoalescer()
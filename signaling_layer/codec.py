@@ -0,0 +1,72 @@
+import json
+
+import msgpack
+
+# Codec tags, as carried in the routing envelope.
+JSON = "j"
+MSGPACK = "m"
+
+# Offered by clients in Sec-WebSocket-Protocol to opt in to binary frames.
+SUBPROTOCOL_MSGPACK = "streamlink.msgpack.v1"
+
+CODECS = {"json": JSON, "msgpack": MSGPACK}
+
+_JSON_SCALARS = (str, int, float, bool, type(None))
+
+
+class FrameError(ValueError):
+    """A client frame that can't be decoded into a message every peer can receive."""
+
+
+def encode(obj, codec: str) -> bytes:
+    if codec == MSGPACK:
+        return msgpack.packb(obj, use_bin_type=True)
+    return json.dumps(obj).encode()
+
+
+def decode(data, codec: str):
+    if codec == MSGPACK:
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data)
+
+
+def transcode(payload: bytes, src: str, dst: str) -> bytes:
+    if src == dst:
+        return payload
+    return encode(decode(payload, src), dst)
+
+
+def _check_json_compatible(obj):
+    """Rejects MessagePack values JSON can't carry (bin, ext, non-string keys), since peers may be on JSON."""
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if not isinstance(key, str):
+                    raise FrameError(f"non-string key of type {type(key).__name__}")
+                stack.append(item)
+        elif isinstance(value, list):
+            stack.extend(value)
+        elif not isinstance(value, _JSON_SCALARS):
+            raise FrameError(f"value of type {type(value).__name__}")
+
+
+def decode_frame(message: dict) -> dict:
+    """Decodes an ASGI websocket.receive message: text frames are JSON, binary frames MessagePack.
+
+    Raises FrameError for anything that isn't a well-formed message object.
+    """
+    try:
+        if message.get("text") is not None:
+            data = json.loads(message["text"])
+        else:
+            data = msgpack.unpackb(message["bytes"], raw=False)
+            _check_json_compatible(data)
+    except FrameError:
+        raise
+    except (ValueError, TypeError, RecursionError, msgpack.UnpackException) as e:
+        raise FrameError(str(e)) from e
+    if not isinstance(data, dict):
+        raise FrameError(f"expected an object, got {type(data).__name__}")
+    return data
@@ -1,4 +1,5 @@
 import os
+import uuid
 
 
 HOST = os.getenv("SIGNALING_HOST", "0.0.0.0")
@@ -9,5 +10,157 @@ MANAGEMENT_SERVICE_PORT = int(os.getenv("MANAGEMENT_PORT", 50051))
 
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://127.0.0.1:6379")
+# Command connections to Redis; callers wait up to REDIS_POOL_TIMEOUT seconds for a free one.
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", 128))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
 
-print(f"Config Loaded: Mgmt={MANAGEMENT_SERVICE_HOST}:{MANAGEMENT_SERVICE_PORT}, Redis={REDIS_URL}")
+# Unique per process; used for the node:{NODE_ID} unicast channel.
+NODE_ID = os.getenv("SIGNALING_NODE_ID") or uuid.uuid4().hex[:12]
+
+# WebSocket base URL clients use to reach this node directly; published in
+# the node heartbeat for room-affinity routing.
+ADVERTISE_URL = os.getenv("SIGNALING_ADVERTISE_URL", f"ws://localhost:{PORT}")
+
+# gRPC client tuning (seconds unless noted)
+GRPC_TIMEOUT = float(os.getenv("GRPC_TIMEOUT", 2.0))
+GRPC_MAX_RETRIES = int(os.getenv("GRPC_MAX_RETRIES", 2))
+GRPC_RETRY_BACKOFF = float(os.getenv("GRPC_RETRY_BACKOFF", 0.1))
+GRPC_BREAKER_THRESHOLD = int(os.getenv("GRPC_BREAKER_THRESHOLD", 5))
+GRPC_BREAKER_RESET = float(os.getenv("GRPC_BREAKER_RESET", 10.0))
+
+# Admission cache for ValidateJoin results. Bans invalidate entries
+# immediately via the global_control channel.
+ADMISSION_CACHE_TTL = float(os.getenv("ADMISSION_CACHE_TTL", 30))
+ADMISSION_NEGATIVE_TTL = float(os.getenv("ADMISSION_NEGATIVE_TTL", 5))
+ADMISSION_CACHE_SIZE = int(os.getenv("ADMISSION_CACHE_SIZE", 100000))
+
+# Room fan-out. Target: a 100-member room fans out in under FANOUT_TARGET_MS;
+# anything slower is logged so regressions show up in the node logs.
+FANOUT_TARGET_MS = float(os.getenv("FANOUT_TARGET_MS", 20.0))
+
+# Per-connection outbound queues. A socket whose send takes longer than
+# SEND_TIMEOUT, or that overflows its queue SEND_QUEUE_MAX_OVERFLOWS times
+# without draining, is disconnected.
+SEND_TIMEOUT = float(os.getenv("SEND_TIMEOUT", 0.5))
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", 256))
+SEND_QUEUE_MAX_OVERFLOWS = int(os.getenv("SEND_QUEUE_MAX_OVERFLOWS", 64))
+# Message types that may be dropped (oldest first) under backpressure.
+DROPPABLE_TYPES = set(os.getenv("DROPPABLE_TYPES", "chat").split(","))
+
+# Payload encoding on the Redis bus: "json" or "msgpack". Sockets whose
+# negotiated codec differs get a transcoded copy, once per message.
+BUS_CODEC = os.getenv("BUS_CODEC", "json")
+
+# Trickle-ICE coalescing: candidates for the same (sender, target) pair that
+# arrive within the window are relayed as one `candidates` message.
+# CANDIDATE_WINDOW_MS=0 relays every candidate on its own.
+CANDIDATE_WINDOW_MS = float(os.getenv("CANDIDATE_WINDOW_MS", 20))
+CANDIDATE_BATCH_MAX = int(os.getenv("CANDIDATE_BATCH_MAX", 32))
+
+# Room bus backend: "pubsub" (fire-and-forget) or "streams" (Redis Streams
+# with bounded replay after a reconnect).
+BUS_BACKEND = os.getenv("BUS_BACKEND", "pubsub")
+STREAM_MAXLEN = int(os.getenv("STREAM_MAXLEN", 1000))
+# Every XADD refreshes the stream's TTL (seconds), so streams of rooms that
+# went quiet are deleted instead of holding STREAM_MAXLEN entries forever.
+STREAM_TTL = int(os.getenv("STREAM_TTL", 3600))
+STREAM_BLOCK_MS = int(os.getenv("STREAM_BLOCK_MS", 100))
+STREAM_READ_COUNT = int(os.getenv("STREAM_READ_COUNT", 500))
+
+# Pub/sub fan-in: room channels are hashed across PUBSUB_SHARDS connections
+# to one Redis server, each with its own listener task. Redis Cluster is not
+# supported: REDIS_URL must be a standalone server (or a single-endpoint proxy).
+PUBSUB_SHARDS = int(os.getenv("PUBSUB_SHARDS", 4))
+PUBSUB_RECONNECT_BACKOFF = float(os.getenv("PUBSUB_RECONNECT_BACKOFF", 0.05))
+PUBSUB_RECONNECT_BACKOFF_MAX = float(os.getenv("PUBSUB_RECONNECT_BACKOFF_MAX", 2.0))
+
+# Node liveness: the node refreshes node_alive:{NODE_ID} every interval.
+# When the key expires, the management layer treats the node as dead and
+# drops the occupancy it reported.
+NODE_HEARTBEAT_INTERVAL = float(os.getenv("NODE_HEARTBEAT_INTERVAL", 5))
+NODE_TTL = int(os.getenv("NODE_TTL", 15))
+
+# Worker processes started by serve.py, each a separate node on the shared port.
+# With SIGNALING_WORKER_PORT_BASE set, worker i also listens on base+i and
+# advertises ws://SIGNALING_PUBLIC_HOST:base+i, so affinity routing can
+# address it directly. Without it all workers advertise the same URL, the
+# kernel picks the worker, and affinity routing leaves them out.
+SIGNALING_WORKERS = int(os.getenv("SIGNALING_WORKERS", os.cpu_count() or 1))
+SIGNALING_WORKER_PORT_BASE = int(os.getenv("SIGNALING_WORKER_PORT_BASE", 0))
+SIGNALING_PUBLIC_HOST = os.getenv("SIGNALING_PUBLIC_HOST", "localhost")
+
+# Room affinity: rooms are placed on a consistent-hash ring of nodes, skipping
+# nodes above AFFINITY_LOAD_FACTOR x the average connection count.
+AFFINITY_VNODES = int(os.getenv("AFFINITY_VNODES", 128))
+AFFINITY_LOAD_FACTOR = float(os.getenv("AFFINITY_LOAD_FACTOR", 1.25))
+
+# Graceful drain on shutdown: clients get a `reconnect` hint and are closed
+# (1012) at a random point within DRAIN_SPREAD seconds, so the rest of the
+# cluster sees at most ~connections/DRAIN_SPREAD rejoins per second. Presence
+# is released in one batch DRAIN_REJOIN_GRACE seconds after the node empties,
+# and the node exits by DRAIN_DEADLINE no matter what.
+DRAIN_SPREAD = float(os.getenv("DRAIN_SPREAD", 10))
+DRAIN_REJOIN_GRACE = float(os.getenv("DRAIN_REJOIN_GRACE", 6))
+DRAIN_DEADLINE = float(os.getenv("DRAIN_DEADLINE", 30))
+
+# Application-level heartbeat. Sockets silent for HEARTBEAT_INTERVAL get a
+# ping; heartbeat-capable clients that stay silent HEARTBEAT_TIMEOUT longer
+# are reaped. All timers live on one wheel advancing every HEARTBEAT_TICK.
+HEARTBEAT_TICK = float(os.getenv("HEARTBEAT_TICK", 1.0))
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", 20))
+HEARTBEAT_TIMEOUT = float(os.getenv("HEARTBEAT_TIMEOUT", 10))
+
+# permessage-deflate on client sockets. Messages under WS_DEFLATE_THRESHOLD
+# bytes go out uncompressed. Each socket keeps roughly
+# 2^(WINDOW_BITS+2) + 2^(MEM_LEVEL+9) bytes of compressor state plus
+# 2^CLIENT_WINDOW_BITS of decompressor window; WS_DEFLATE_NO_CONTEXT_TAKEOVER=1
+# frees both between messages at some cost in ratio.
+WS_DEFLATE = os.getenv("WS_DEFLATE", "1") == "1"
+WS_DEFLATE_THRESHOLD = int(os.getenv("WS_DEFLATE_THRESHOLD", 512))
+WS_DEFLATE_WINDOW_BITS = int(os.getenv("WS_DEFLATE_WINDOW_BITS", 12))
+WS_DEFLATE_CLIENT_WINDOW_BITS = int(os.getenv("WS_DEFLATE_CLIENT_WINDOW_BITS", 12))
+WS_DEFLATE_MEM_LEVEL = int(os.getenv("WS_DEFLATE_MEM_LEVEL", 5))
+WS_DEFLATE_NO_CONTEXT_TAKEOVER = os.getenv("WS_DEFLATE_NO_CONTEXT_TAKEOVER", "0") == "1"
+
+# The event-loop lag monitor behind /metrics wakes up this often (seconds).
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.5))
+
+# Join-path tracing (see tracing.py): a TRACE_SAMPLE_RATE fraction of joins
+# is kept, plus every join slower than TRACE_SLOW_MS, in a ring buffer of
+# the last TRACE_BUFFER traces. Both at 0 turns tracing off.
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.01))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", 500))
+TRACE_BUFFER = int(os.getenv("TRACE_BUFFER", 256))
+
+# Inbound rate limits as "type=rate:burst,..." (messages per second, bucket
+# size). RATE_LIMITS applies to each connection, ROOM_RATE_LIMITS to each
+# room on this node. Message types not listed are not limited; a rate of 0
+# refuses the type outright.
+#
+# Signaling bursts are sized from the largest mesh room, not fixed: a joiner
+# answers every member's offer at once and trickles about
+# CANDIDATES_PER_PEER ICE candidates to each, and the client never resends
+# a throttled message, so a burst smaller than that leaves peers unconnected.
+MAX_MESH_ROOM_SIZE = int(os.getenv("MAX_MESH_ROOM_SIZE", 50))
+CANDIDATES_PER_PEER = int(os.getenv("CANDIDATES_PER_PEER", 20))
+def _parse_limits(spec: str) -> dict:
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        msg_type, _, values = item.partition("=")
+        rate, _, burst = values.partition(":")
+        limits[msg_type.strip()] = (float(rate), float(burst or rate))
+    return limits
+
+_PEERS = MAX_MESH_ROOM_SIZE
+_CANDIDATES = MAX_MESH_ROOM_SIZE * CANDIDATES_PER_PEER
+RATE_LIMITS = _parse_limits(os.getenv(
+    "RATE_LIMITS",
+    f"chat=2:10,offer=5:{_PEERS},answer=5:{_PEERS},candidate=100:{_CANDIDATES}",
+))
+# Every member of a room answers (or offers to) a joiner at the same time.
+ROOM_RATE_LIMITS = _parse_limits(os.getenv(
+    "ROOM_RATE_LIMITS",
+    f"chat=20:60,offer=50:{2 * _PEERS},answer=50:{2 * _PEERS},candidate=1000:{2 * _CANDIDATES}",
+))
+
+print(f"Config Loaded: Node={NODE_ID}, Bus={BUS_BACKEND}, Mgmt={MANAGEMENT_SERVICE_HOST}:{MANAGEMENT_SERVICE_PORT}, Redis={REDIS_URL}")
@@ -1,75 +1,277 @@
 from typing import List, Dict
 from fastapi import WebSocket
-import collections
+import asyncio
+import time
+
+import codec
+import config
+import metrics
+from outbound_queue import OutboundQueue, DROP_OLDEST, NEVER_DROP
+from candidate_coalescer import CAP_CANDIDATES
+from heartbeat import heartbeat
+from rate_limiter import limiter
+
+
+class Connection:
+    """Everything the node tracks about one socket, in a single slotted record."""
+
+    __slots__ = ("websocket", "room_id", "user_id", "joined_at", "codec", "caps", "queue", "received", "last_seen", "pinged", "buckets", "throttled_until")
+
+    def __init__(self, websocket: WebSocket, room_id: int, user_id: int, client_codec: str, caps: frozenset):
+        self.websocket = websocket
+        self.room_id = room_id
+        self.user_id = user_id
+        self.joined_at = time.monotonic()
+        self.codec = client_codec
+        self.caps = caps
+        self.queue = None
+        self.received = 0
+        self.last_seen = self.joined_at
+        # monotonic time of the outstanding heartbeat ping, 0.0 when none
+        self.pinged = 0.0
+        # msg_type -> TokenBucket, created on first use
+        self.buckets = {}
+        # msg_type -> monotonic time until which throttle notices for it are suppressed
+        self.throttled_until = {}
+
 
 class ConnectionManager:
     def __init__(self):
 
-        self.active_connections: Dict[int, List[WebSocket]] = collections.defaultdict(list)
+        # room_id -> user_id -> {websocket: Connection}; the inner dict is an
+        # insertion-ordered set, so every lookup and removal is O(1).
+        self.rooms: Dict[int, Dict[int, Dict[WebSocket, Connection]]] = {}
+
+        self.connections: Dict[WebSocket, Connection] = {}
+
+        self.room_counts: Dict[int, int] = {}
+
+        self.slow_detached = 0
+        # Messages dropped by queues of connections that have since closed.
+        self.closed_dropped = 0
+        self._close_tasks = set()
 
-        self.socket_to_room: Dict[WebSocket, int] = {}
+        # Set while the node hands its clients off before shutting down.
+        self.draining = False
+        # (room_id, user_id) pairs whose presence is released in one batch at the end of a drain.
+        self.drained = set()
+        # Sockets the heartbeat reaped; their leave path already ran in the reap batch.
+        self.reaped = set()
 
-        self.socket_to_user: Dict[WebSocket, int] = {}
+    async def connect(self, websocket: WebSocket, room_id: int, user_id: int, client_codec: str = codec.JSON, caps: frozenset = frozenset()):
 
-    async def connect(self, websocket: WebSocket, room_id: int, user_id: int):
+        conn = Connection(websocket, room_id, user_id, client_codec, caps)
+        conn.queue = OutboundQueue(websocket, self._detach)
 
-        self.active_connections[room_id].append(websocket)
-        self.socket_to_room[websocket] = room_id
-        self.socket_to_user[websocket] = user_id
+        self.rooms.setdefault(room_id, {}).setdefault(user_id, {})[websocket] = conn
+        self.connections[websocket] = conn
+        self.room_counts[room_id] = self.room_counts.get(room_id, 0) + 1
+        heartbeat.track(conn)
         print(f"User {user_id} connected to Room {room_id}")
 
     def disconnect(self, websocket: WebSocket):
-        room_id = self.socket_to_room.get(websocket)
-        user_id = self.socket_to_user.get(websocket)
-        
-        if room_id and websocket in self.active_connections[room_id]:
-            self.active_connections[room_id].remove(websocket)
-            if not self.active_connections[room_id]:
-                del self.active_connections[room_id]
-        
-        if websocket in self.socket_to_room:
-            del self.socket_to_room[websocket]
-        if websocket in self.socket_to_user:
-            del self.socket_to_user[websocket]
-            
-        return room_id, user_id
-
-    async def broadcast_to_room(self, room_id: int, message: str, exclude: WebSocket = None):
-        """Sends a message to all local sockets in the room."""
-        if room_id in self.active_connections:
-            for connection in self.active_connections[room_id]:
-                if connection != exclude:
-                    try:
-                        await connection.send_text(message)
-                    except Exception as e:
-                        print(f"Error broadcasting: {e}")
+        conn = self.connections.pop(websocket, None)
+        if conn is None:
+            return None, None
+
+        users = self.rooms[conn.room_id]
+        sockets = users[conn.user_id]
+        del sockets[websocket]
+        if not sockets:
+            del users[conn.user_id]
+        if not users:
+            del self.rooms[conn.room_id]
+
+        remaining = self.room_counts[conn.room_id] - 1
+        if remaining:
+            self.room_counts[conn.room_id] = remaining
+        else:
+            del self.room_counts[conn.room_id]
+            limiter.forget_room(conn.room_id)
+
+        self.closed_dropped += conn.queue.dropped
+        conn.queue.close()
+        heartbeat.untrack(conn)
+        return conn.room_id, conn.user_id
+
+    def get_connection(self, websocket: WebSocket):
+        return self.connections.get(websocket)
+
+    def _room_connections(self, room_id: int):
+        for sockets in self.rooms.get(room_id, {}).values():
+            yield from sockets.values()
+
+    def _user_connections(self, room_id: int, user_id: int):
+        return list(self.rooms.get(room_id, {}).get(user_id, {}).values())
+
+    def _detach(self, websocket: WebSocket, error: Exception):
+        """Drops a socket that failed, timed out mid-send or overflowed, and closes it in the background.
+
+        A timed-out send may have left a partial frame on the wire, so the socket
+        cannot be reused. The endpoint's receive loop sees the close and runs the
+        usual leave path.
+        """
+        if websocket not in self.connections:
+            return
+        room_id, user_id = self.disconnect(websocket)
+        self.slow_detached += 1
+        if isinstance(error, asyncio.TimeoutError):
+            metrics.send_failures["timeout"].inc()
+            kind = "send timed out"
+        elif error is None:
+            metrics.send_failures["overflow"].inc()
+            kind = "outbound queue overflowed"
+        else:
+            metrics.send_failures["error"].inc()
+            kind = f"send failed: {error!r}"
+        print(f"Detaching User {user_id} from Room {room_id}: {kind}")
+
+        self._close_in_background(websocket, 1013, "Too slow")
+
+    def reap(self, websocket: WebSocket):
+        """Drops a socket that stopped answering heartbeats and closes it in the background."""
+        if websocket not in self.connections:
+            return
+        self.disconnect(websocket)
+        self.reaped.add(websocket)
+        self._close_in_background(websocket, 1001, "Heartbeat timeout")
+
+    def close_for_drain(self, websocket: WebSocket):
+        """Closes a socket with 1012 so the client reconnects to another node."""
+        if websocket in self.connections:
+            self._close_in_background(websocket, 1012, "Service Restart")
+
+    def _close_in_background(self, websocket: WebSocket, code: int, reason: str):
+        task = asyncio.create_task(self._close_quietly(websocket, code, reason))
+        self._close_tasks.add(task)
+        task.add_done_callback(self._close_tasks.discard)
+
+    async def _close_quietly(self, websocket: WebSocket, code: int, reason: str):
+        try:
+            await asyncio.wait_for(websocket.close(code=code, reason=reason), timeout=config.SEND_TIMEOUT)
+        except Exception:
+            pass
+
+    @staticmethod
+    def _frame(payload: bytes, payload_codec: str, client_codec: str, frames: dict):
+        """Returns the frame for a client codec, transcoding at most once per codec per message."""
+        frame = frames.get(client_codec)
+        if frame is None:
+            frame = codec.transcode(payload, payload_codec, client_codec)
+            if client_codec == codec.JSON:
+                frame = frame.decode()
+            frames[client_codec] = frame
+        return frame
+
+    def send_object(self, websocket: WebSocket, obj: dict, policy: str = NEVER_DROP) -> bool:
+        """Encodes a message in the socket's negotiated codec and queues it."""
+        conn = self.connections.get(websocket)
+        client_codec = conn.codec if conn else codec.JSON
+        frame = codec.encode(obj, client_codec)
+        return self.send_personal(websocket, frame.decode() if client_codec == codec.JSON else frame, policy)
+
+    def send_personal(self, websocket: WebSocket, message, policy: str = NEVER_DROP) -> bool:
+        """Queues an already-encoded frame (str for text, bytes for binary) without waiting on the network."""
+        conn = self.connections.get(websocket)
+        if conn is None:
+            return False
+        if not conn.queue.put(message, policy):
+            self._detach(websocket, None)
+            return False
+        return True
+
+    async def broadcast_to_room(self, room_id: int, payload: bytes, exclude: WebSocket = None, policy: str = NEVER_DROP, payload_codec: str = codec.JSON) -> List[WebSocket]:
+        """Sends a message to all local sockets in the room.
+
+        Messages are handed to each socket's outbound queue, so this never waits
+        on a slow peer. Returns the sockets that were detached for overflowing.
+        """
+        targets = [conn for conn in self._room_connections(room_id) if conn.websocket is not exclude]
+        if not targets:
+            return []
+
+        start = time.perf_counter()
+        frames = {}
+        detached = [
+            conn.websocket for conn in targets
+            if not self.send_personal(conn.websocket, self._frame(payload, payload_codec, conn.codec, frames), policy)
+        ]
+        elapsed = time.perf_counter() - start
+        metrics.fanout_seconds.observe(elapsed)
+        elapsed_ms = elapsed * 1000
+
+        if elapsed_ms > config.FANOUT_TARGET_MS:
+            print(f"Slow fan-out in Room {room_id}: {len(targets)} sockets in {elapsed_ms:.1f}ms, {len(detached)} detached")
+        return detached
+
+    async def send_to_user(self, room_id: int, user_id: int, payload: bytes, policy: str = NEVER_DROP, payload_codec: str = codec.JSON) -> bool:
+        """Sends a message only to the given user's local sockets in the room."""
+        delivered = False
+        frames = {}
+        for conn in self._user_connections(room_id, user_id):
+            frame = self._frame(payload, payload_codec, conn.codec, frames)
+            delivered = self.send_personal(conn.websocket, frame, policy) or delivered
+        return delivered
+
+    def send_candidates(self, room_id: int, target_id: int, payload: bytes, payload_codec: str = codec.JSON):
+        """Delivers a coalesced `candidates` batch.
+
+        Sockets that advertised CAP_CANDIDATES get the batch as one frame; older
+        clients get it split back into individual `candidate` messages.
+        """
+        frames = {}
+        split = None
+        if target_id is not None:
+            targets = self._user_connections(room_id, target_id)
+        else:
+            targets = list(self._room_connections(room_id))
+
+        for conn in targets:
+            if CAP_CANDIDATES in conn.caps:
+                self.send_personal(conn.websocket, self._frame(payload, payload_codec, conn.codec, frames))
+                continue
+            if split is None:
+                batch = codec.decode(payload, payload_codec)
+                split = [
+                    {"type": "candidate", "user_id": batch["user_id"], "target_id": batch["target_id"], "data": candidate}
+                    for candidate in batch["data"]
+                ]
+            for message in split:
+                self.send_object(conn.websocket, message)
+
+    def get_queue_stats(self) -> dict:
+        """Outbound queue depth and drop counters for this node."""
+        depths = [conn.queue.depth for conn in self.connections.values()]
+        return {
+            "connections": len(depths),
+            "queued": sum(depths),
+            "max_depth": max(depths, default=0),
+            "dropped": self.closed_dropped + sum(conn.queue.dropped for conn in self.connections.values()),
+            "detached": self.slow_detached,
+        }
+
+    @staticmethod
+    def policy_for(msg_type: str) -> str:
+        return DROP_OLDEST if msg_type in config.DROPPABLE_TYPES else NEVER_DROP
 
     def get_room_count(self, room_id: int) -> int:
-        return len(self.active_connections.get(room_id, []))
+        return self.room_counts.get(room_id, 0)
+
+    def has_user(self, room_id: int, user_id: int) -> bool:
+        return user_id in self.rooms.get(room_id, {})
 
     def get_active_users(self, room_id: int) -> List[int]:
         """Returns a list of unique user IDs currently in the room."""
-        users = set()
-        if room_id in self.active_connections:
-            for ws in self.active_connections[room_id]:
-                uid = self.socket_to_user.get(ws)
-                if uid:
-                    users.add(uid)
-        return list(users)
+        return list(self.rooms.get(room_id, {}))
 
     async def kick_user(self, room_id: int, user_id: int):
         """Disconnects a specific user from the room."""
-        target_ws = None
-        if room_id in self.active_connections:
-            for ws in self.active_connections[room_id]:
-                if self.socket_to_user.get(ws) == user_id:
-                    target_ws = ws
-                    break
-        
-        if target_ws:
+        targets = self._user_connections(room_id, user_id)
+        if targets:
             print(f"Kicking User {user_id} from Room {room_id}")
+        for conn in targets:
             try:
-                await target_ws.close(code=4003, reason="You have been blocked from this room.")
+                await conn.websocket.close(code=4003, reason="You have been blocked from this room.")
 
             except Exception as e:
                 print(f"Error closing socket for kicked user: {e}")
@@ -0,0 +1,27 @@
+"""Routing envelope for messages on the Redis bus.
+
+    <type> US <origin node> US <room id> US <target user> US <codec> RS <payload>
+
+The header is ASCII and never contains RS (0x1e), so it can be split off with
+one partition() and the payload forwarded to sockets byte-for-byte without ever
+being decoded. An empty target means "whole room"; codec is codec.JSON or
+codec.MSGPACK.
+"""
+
+FIELD_SEP = "\x1f"
+HEADER_END = b"\x1e"
+
+
+def pack(msg_type: str, origin: str, room_id: int, target, codec: str, payload: bytes) -> bytes:
+    target = "" if target is None else target
+    header = FIELD_SEP.join((msg_type, origin, str(room_id), str(target), codec))
+    return header.encode() + HEADER_END + payload
+
+
+def unpack(data: bytes):
+    """Returns (type, origin, room_id, target, codec, payload), or None for a legacy bare-JSON message."""
+    header, sep, payload = data.partition(HEADER_END)
+    if not sep:
+        return None
+    msg_type, origin, room, target, codec = header.decode().split(FIELD_SEP)
+    return msg_type, origin, int(room), int(target) if target else None, codec, payload
@@ -1,40 +1,173 @@
+import asyncio
+import random
+import time
+
 import grpc
 import service_pb2
 import service_pb2_grpc
 import config
+import metrics
+from tracing import tracer, grpc_metadata
+from admission_cache import AdmissionCache
+
+# Codes where the request never reached the servicer, so a retry is always safe.
+RETRYABLE_CODES = {grpc.StatusCode.UNAVAILABLE}
+
+# Extra codes that are only safe to retry for read-only calls like ValidateJoin.
+IDEMPOTENT_RETRYABLE_CODES = RETRYABLE_CODES | {grpc.StatusCode.DEADLINE_EXCEEDED}
+
+
+class CircuitOpenError(Exception):
+    """Raised when the breaker is open and the call is rejected without touching the network."""
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed -> open -> half-open (one probe) -> closed."""
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        state = self.state
+        if state == "open":
+            raise CircuitOpenError("Management service circuit is open")
+        if state == "half_open":
+            if self.probe_in_flight:
+                raise CircuitOpenError("Management service circuit is half-open, probe in flight")
+            self.probe_in_flight = True
+
+    def release_probe(self):
+        """Ends a call that neither succeeded nor failed at the RPC level (cancelled, local error)."""
+        self.probe_in_flight = False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            print("gRPC circuit closed, management service reachable again")
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                print(f"gRPC circuit opened after {self.failures} consecutive failures")
+            self.opened_at = time.monotonic()
+
 
 class GrpcClient:
     def __init__(self):
-        target = f"{config.MANAGEMENT_SERVICE_HOST}:{config.MANAGEMENT_SERVICE_PORT}"
-        self.channel = grpc.insecure_channel(target)
-        self.stub = service_pb2_grpc.ManagementServiceStub(self.channel)
-        print(f"gRPC Client connected to {target}")
+        self.target = f"{config.MANAGEMENT_SERVICE_HOST}:{config.MANAGEMENT_SERVICE_PORT}"
+        self.channel = None
+        self.stub = None
+        self.breaker = CircuitBreaker(config.GRPC_BREAKER_THRESHOLD, config.GRPC_BREAKER_RESET)
+        self.admission = AdmissionCache()
+        # Lets the management layer attribute occupancy to this node.
+        self.metadata = (("x-node-id", config.NODE_ID),)
 
-    async def validate_join(self, user_id: int, room_id: int):
+    def _get_stub(self):
+        # grpc.aio channels bind to the running event loop, so create lazily on first use.
+        if self.stub is None:
+            self.channel = grpc.aio.insecure_channel(self.target)
+            self.stub = service_pb2_grpc.ManagementServiceStub(self.channel)
+            print(f"gRPC Client connected to {self.target}")
+        return self.stub
+
+    async def close(self):
+        if self.channel is not None:
+            await self.channel.close()
+            self.channel = None
+            self.stub = None
+
+    async def _call(self, method: str, request, idempotent: bool = False):
+        """Runs one unary RPC with a deadline, jittered retries and the circuit breaker."""
+        start = time.perf_counter()
         try:
+            with tracer.span(f"grpc.{method}"):
+                return await self._attempt(method, request, idempotent)
+        except Exception:
+            metrics.grpc_errors[method].inc()
+            raise
+        finally:
+            metrics.grpc_seconds[method].observe(time.perf_counter() - start)
+
+    async def _attempt(self, method: str, request, idempotent: bool):
+        retryable = IDEMPOTENT_RETRYABLE_CODES if idempotent else RETRYABLE_CODES
+        attempt = 0
+        metadata = grpc_metadata(self.metadata)
+        while True:
+            self.breaker.before_call()
+            try:
+                rpc = getattr(self._get_stub(), method)
+                response = await rpc(request, timeout=config.GRPC_TIMEOUT, metadata=metadata)
+            except grpc.aio.AioRpcError as e:
+                self.breaker.record_failure()
+                if e.code() not in retryable or attempt >= config.GRPC_MAX_RETRIES:
+                    raise
+                # Full jitter keeps a join storm from retrying in lockstep.
+                backoff = config.GRPC_RETRY_BACKOFF * (2 ** attempt)
+                await asyncio.sleep(random.uniform(0, backoff))
+                attempt += 1
+                tracer.annotate(retries=attempt)
+                continue
+            except BaseException:
+                # Otherwise a cancelled half-open probe would stay "in flight" and block every call.
+                self.breaker.release_probe()
+                raise
+            self.breaker.record_success()
+            return response
 
-            response = self.stub.ValidateJoin(service_pb2.JoinRequest(user_id=user_id, room_id=room_id))
+    async def validate_join(self, user_id: int, room_id: int):
+        cached = self.admission.get(room_id, user_id)
+        if cached is not None:
+            tracer.annotate(cached=True)
+            return cached
+
+        epoch = self.admission.epoch
+        try:
+            response = await self._call(
+                "ValidateJoin",
+                service_pb2.JoinRequest(user_id=user_id, room_id=room_id),
+                idempotent=True,
+            )
+            self.admission.put(room_id, user_id, response.allowed, response.reason, epoch)
             return response.allowed, response.reason
+        except CircuitOpenError as e:
+            print(f"gRPC Validation Rejected: {e}")
+            return False, "Service Unavailable"
         except grpc.RpcError as e:
             print(f"gRPC Validation Failed: {e}")
             return False, "Internal Error"
 
     async def user_joined(self, user_id: int, room_id: int):
         try:
-            self.stub.UserJoined(service_pb2.JoinRequest(user_id=user_id, room_id=room_id))
-        except grpc.RpcError as e:
+            await self._call("UserJoined", service_pb2.JoinRequest(user_id=user_id, room_id=room_id))
+        except (grpc.RpcError, CircuitOpenError) as e:
             print(f"gRPC UserJoined Failed: {e}")
 
     async def user_left(self, user_id: int, room_id: int):
         try:
-            self.stub.UserLeft(service_pb2.JoinRequest(user_id=user_id, room_id=room_id))
-        except grpc.RpcError as e:
+            await self._call("UserLeft", service_pb2.JoinRequest(user_id=user_id, room_id=room_id))
+        except (grpc.RpcError, CircuitOpenError) as e:
             print(f"gRPC UserLeft Failed: {e}")
 
     async def store_message(self, user_id: int, room_id: int, content: str):
         try:
-            self.stub.StoreMessage(service_pb2.MessageRequest(user_id=user_id, room_id=room_id, content=content))
-        except grpc.RpcError as e:
+            await self._call("StoreMessage", service_pb2.MessageRequest(user_id=user_id, room_id=room_id, content=content))
+        except (grpc.RpcError, CircuitOpenError) as e:
             print(f"gRPC StoreMessage Failed: {e}")
 
 
@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+import config
+from timer_wheel import TimerWheel
+
+# Clients that answer {"type": "ping"} with any frame advertise this in ?caps=.
+CAP_HEARTBEAT = "heartbeat"
+
+
+class HeartbeatScheduler:
+    """Application-level liveness for every socket, driven by one timer wheel.
+
+    Each connection has a single timer. When it fires, a connection that has
+    sent something within HEARTBEAT_INTERVAL is simply re-armed for the rest
+    of the interval; an idle one is pinged and given HEARTBEAT_TIMEOUT to
+    answer. A heartbeat-capable client that has sent nothing since its ping
+    when that runs out is reaped. Everything reaped in one tick is handed to the reap callback as
+    one batch.
+    """
+
+    def __init__(self):
+        self.wheel = TimerWheel(config.HEARTBEAT_TICK)
+        self.task = None
+        self.ping_callback = None
+        self.reap_callback = None
+
+        self.pings = 0
+        self.reaped = 0
+        self.reap_batches = 0
+
+    def set_callbacks(self, ping_callback, reap_callback):
+        """ping_callback(conn) sends a ping; async reap_callback(conns) removes dead connections."""
+        self.ping_callback = ping_callback
+        self.reap_callback = reap_callback
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    def track(self, conn):
+        conn.last_seen = time.monotonic()
+        conn.pinged = 0.0
+        self.wheel.schedule(conn, config.HEARTBEAT_INTERVAL)
+
+    def untrack(self, conn):
+        self.wheel.cancel(conn)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += config.HEARTBEAT_TICK
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+            due = self.wheel.advance()
+            if due:
+                try:
+                    await self._expire(due)
+                except Exception as e:
+                    print(f"Heartbeat tick failed: {e}")
+
+    async def _expire(self, due):
+        now = time.monotonic()
+        dead = []
+        for conn in due:
+            if conn.pinged and conn.last_seen < conn.pinged:
+                # Nothing at all since the ping.
+                if CAP_HEARTBEAT in conn.caps:
+                    dead.append(conn)
+                    continue
+                # Older clients never answer pings, so silence proves nothing; keep pinging.
+                conn.pinged = 0.0
+                self.wheel.schedule(conn, config.HEARTBEAT_INTERVAL)
+                continue
+
+            conn.pinged = 0.0
+            idle = now - conn.last_seen
+            if idle < config.HEARTBEAT_INTERVAL:
+                self.wheel.schedule(conn, config.HEARTBEAT_INTERVAL - idle)
+            else:
+                conn.pinged = now
+                self.pings += 1
+                self.ping_callback(conn)
+                self.wheel.schedule(conn, config.HEARTBEAT_TIMEOUT)
+
+        if dead and self.reap_callback:
+            self.reaped += len(dead)
+            self.reap_batches += 1
+            await self.reap_callback(dead)
+
+    def stats(self) -> dict:
+        return {
+            "tracked": len(self.wheel),
+            "pings": self.pings,
+            "reaped": self.reaped,
+            "reap_batches": self.reap_batches,
+        }
+
+
+heartbeat = HeartbeatScheduler()
@@ -1,23 +1,46 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse
 import asyncio
 import json
+import math
+import random
+import time
 import uvicorn
 from contextlib import asynccontextmanager
 
 from connection_manager import manager
 from redis_manager import redis_manager
 from grpc_client import grpc_client
+from candidate_coalescer import coalescer
+from affinity import router
+from heartbeat import heartbeat
+from rate_limiter import limiter
+from ws_compression import DeflateWebSocketProtocol, deflate_metrics
+from tracing import tracer
 import config
+import codec
+import envelope
+import metrics
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
 
     print("Starting redis")
     await redis_manager.set_callback(handle_redis_message)
+    await redis_manager.set_gap_callback(handle_bus_gap)
+    await redis_manager.set_control_gap_callback(handle_control_gap)
+    await redis_manager.set_status_callback(node_status)
     await redis_manager.connect()
+    coalescer.set_callback(flush_candidates)
+    heartbeat.set_callbacks(ping_connection, handle_reaped)
+    heartbeat.start()
+    metrics.loop_lag.start()
     yield
 
     print("Shutting down")
+    await flush_drained_presence()
+    await redis_manager.close()
+    await grpc_client.close()
 
 app = FastAPI(lifespan=lifespan)
 from fastapi.middleware.cors import CORSMiddleware
@@ -31,43 +54,362 @@ app.add_middleware(
 )
 
 
-async def handle_redis_message(channel: str, data: str):
-    
-    if channel.startswith("room:"):
-        try:
-            room_id = int(channel.split(":")[1])
-            message_data = json.loads(data)
-            
-
-            if message_data.get("type") == "system_kick":
-                target_user_id = message_data.get("user_id")
-                print(f"Received System Kick for User {target_user_id} in Room {room_id}")
-                await manager.kick_user(room_id, target_user_id)
+async def handle_redis_message(channel: str, data: bytes):
+    try:
+        routed = envelope.unpack(data)
+        if routed is None:
+            routed = _unpack_legacy(channel, data)
+            if routed is None:
                 return
+        msg_type, origin, room_id, target_id, payload_codec, payload = routed
 
+        if origin == config.NODE_ID:
+            # Our own echo: local sockets were served before this was published.
+            return
 
-            await manager.broadcast_to_room(room_id, data)
-        except Exception as e:
-            print(f"Error handling redis message: {e}")
+        if msg_type in ("room_node_enter", "room_node_leave"):
+            redis_manager.note_room_node(room_id, origin, msg_type == "room_node_enter")
+            return
+
+        if msg_type == "ban_created":
+            grpc_client.admission.invalidate(room_id, target_id)
+            return
+
+        if msg_type == "system_kick":
+            print(f"Received System Kick for User {target_id} in Room {room_id}")
+            # Kicks come with a ban; don't let a cached admission undo it.
+            grpc_client.admission.invalidate(room_id, target_id)
+            await manager.kick_user(room_id, target_id)
+            return
+
+        router.record_remote()
+
+        if msg_type == "candidates":
+            manager.send_candidates(room_id, target_id, payload, payload_codec)
+            return
+
+        policy = manager.policy_for(msg_type)
+        if target_id is not None:
+            await manager.send_to_user(room_id, target_id, payload, policy=policy, payload_codec=payload_codec)
+        else:
+            await manager.broadcast_to_room(room_id, payload, policy=policy, payload_codec=payload_codec)
+    except Exception as e:
+        print(f"Error handling redis message: {e}")
+
+async def handle_bus_gap(room_ids: list):
+    """Tells clients in rooms that may have missed bus messages to re-sync.
+
+    Also re-registers local users as the Redis state may have been lost.
+    """
+    await redis_manager.refresh_room_nodes(room_ids)
+    notice = codec.encode({"type": "gap"}, codec.JSON)
+    for room_id in room_ids:
+        await redis_manager.register_users(room_id, manager.get_active_users(room_id))
+        await manager.broadcast_to_room(room_id, notice)
+
+async def handle_control_gap():
+    """Ban invalidations may have been lost, so no cached admission can be trusted."""
+    grpc_client.admission.clear()
+    print("Control channel recovered, admission cache cleared")
+
+def _unpack_legacy(channel: str, data: bytes):
+    """Routes a bare-JSON room message from a publisher that predates the envelope."""
+    if not channel.startswith("room:"):
+        return None
+    message_data = json.loads(data)
+    msg_type = message_data.get("type")
+    target_id = message_data.get("user_id") if msg_type == "system_kick" else None
+    return msg_type, None, int(channel.split(":")[1]), target_id, codec.JSON, data
+
+PING = {"type": "ping"}
+
+def ping_connection(conn):
+    manager.send_object(conn.websocket, PING)
+
+async def handle_reaped(conns: list):
+    """Leave path for every connection the heartbeat reaped in one tick, batched."""
+    left = set()
+    for conn in conns:
+        manager.reap(conn.websocket)
+        if not manager.has_user(conn.room_id, conn.user_id):
+            left.add((conn.room_id, conn.user_id))
+    print(f"Reaped {len(conns)} unresponsive connections")
+
+    # Presence for the whole batch in one round trip; users who already
+    # rejoined on another node don't get a user_left.
+    gone = await redis_manager.release_users(left)
+    await asyncio.gather(*(
+        send_to_room(room_id, {"type": "user_left", "user_id": user_id})
+        for room_id, user_id in gone
+    ))
+    for room_id in {room_id for room_id, _ in left}:
+        if manager.get_room_count(room_id) == 0:
+            await redis_manager.unsubscribe(room_id)
+            await router.release_room(room_id)
+    await asyncio.gather(*(grpc_client.user_left(conn.user_id, conn.room_id) for conn in conns))
+
+def node_status() -> dict:
+    """Published in every heartbeat; read by the affinity router on other nodes."""
+    return {"connections": len(manager.connections), "draining": manager.draining}
+
+async def drain_node():
+    """Hands every client off to other nodes before shutdown.
+
+    New joins are refused, and each client gets a `reconnect` hint and is
+    closed with 1012 at a random point within DRAIN_SPREAD, so the reconnect
+    wave is spread out. Returns once the node is empty and the rejoin grace
+    has passed, or at DRAIN_DEADLINE.
+    """
+    if manager.draining:
+        return
+    manager.draining = True
+    try:
+        # Tell the routers right away, not at the next heartbeat.
+        await redis_manager.heartbeat()
+    except Exception as e:
+        print(f"Failed to announce drain: {e}")
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + config.DRAIN_DEADLINE
+    print(f"Draining {len(manager.connections)} connections over {config.DRAIN_SPREAD}s")
+
+    for websocket in list(manager.connections):
+        delay = random.uniform(0, config.DRAIN_SPREAD)
+        manager.send_object(websocket, {"type": "reconnect", "delay_ms": int(delay * 1000)})
+        loop.call_later(delay, manager.close_for_drain, websocket)
+
+    while manager.connections and loop.time() < deadline:
+        await asyncio.sleep(0.1)
+    for websocket in list(manager.connections):
+        manager.close_for_drain(websocket)
+
+    # Users who rejoin elsewhere in the meantime don't get a user_left.
+    await asyncio.sleep(max(0, min(config.DRAIN_REJOIN_GRACE, deadline - loop.time())))
+    await flush_drained_presence()
+
+async def flush_drained_presence():
+    """Releases drained users in one Redis round trip and announces the ones that didn't come back."""
+    drained, manager.drained = manager.drained, set()
+    if not drained:
+        return
+    gone = await redis_manager.release_users(drained)
+    # The drained rooms are already unsubscribed here, so publish unconditionally.
+    await asyncio.gather(*(
+        redis_manager.publish(room_id, {"type": "user_left", "user_id": user_id})
+        for room_id, user_id in gone
+    ))
+    print(f"Released {len(drained)} drained users, {len(drained) - len(gone)} already rejoined elsewhere")
+
+async def send_to_room(room_id: int, message: dict, exclude: WebSocket = None):
+    """Delivers a room message to local sockets right away.
+
+    It only goes out on the bus if another node holds members of the room,
+    and if it does, our own echo is dropped when it comes back.
+    """
+    payload = codec.encode(message, redis_manager.bus_codec)
+    router.record_local()
+    await manager.broadcast_to_room(
+        room_id, payload, exclude=exclude,
+        policy=manager.policy_for(message["type"]), payload_codec=redis_manager.bus_codec,
+    )
+    if redis_manager.room_is_shared(room_id):
+        await redis_manager.publish_encoded(room_id, message["type"], payload)
+        router.bus_publishes += 1
+    else:
+        router.bus_skipped += 1
+
+async def route_signal(room_id: int, payload: dict):
+    """Routes a signaling message point-to-point to the target's home node.
+
+    The room channel is only used when we don't know where the target lives.
+    """
+    target_id = payload.get("target_id")
+    target_node = None
+    if str(target_id).isdigit():
+        if manager.has_user(room_id, int(target_id)):
+            # Local targets never need the user_node lookup.
+            target_node = config.NODE_ID
+        else:
+            target_node = await redis_manager.get_user_node(room_id, int(target_id))
+
+    if target_node == config.NODE_ID:
+        payload_bytes = codec.encode(payload, redis_manager.bus_codec)
+        router.record_local()
+        if payload["type"] == "candidates":
+            manager.send_candidates(room_id, int(target_id), payload_bytes, redis_manager.bus_codec)
+        else:
+            await manager.send_to_user(room_id, int(target_id), payload_bytes, payload_codec=redis_manager.bus_codec)
+    elif target_node:
+        await redis_manager.publish_to_node(target_node, room_id, int(target_id), payload)
+    else:
+        await send_to_room(room_id, payload)
+
+async def flush_candidates(room_id: int, sender_id: int, target_id: int, batch: list):
+    await route_signal(room_id, {
+        "type": "candidates",
+        "user_id": sender_id,
+        "target_id": target_id,
+        "data": batch
+    })
+
+metrics.registry.gauge(
+    "signaling_sockets", "Open client sockets on this node.",
+    lambda: [({}, len(manager.connections))])
+metrics.registry.gauge(
+    "signaling_room_sockets", "Open client sockets per room on this node.",
+    lambda: [({"room": room_id}, count) for room_id, count in manager.room_counts.items()])
+metrics.registry.gauge(
+    "signaling_queued_messages", "Messages waiting in outbound socket queues.",
+    lambda: [({}, manager.get_queue_stats()["queued"])])
+metrics.registry.counter_from(
+    "signaling_queue_dropped_total", "Droppable messages evicted from full outbound queues.",
+    lambda: [({}, manager.get_queue_stats()["dropped"])])
+metrics.registry.counter_from(
+    "signaling_ratelimit_allowed_total", "Client messages that passed the rate limiter.",
+    lambda: [({}, limiter.allowed)])
+metrics.registry.counter_from(
+    "signaling_ratelimit_throttled_total", "Client messages rejected by the rate limiter.",
+    lambda: [({"scope": scope, "type": msg_type}, n) for (scope, msg_type), n in limiter.throttled.items()])
+metrics.registry.counter_from(
+    "signaling_ratelimit_notices_total", "Throttle notices sent to clients.",
+    lambda: [({}, limiter.notices)])
+metrics.registry.gauge(
+    "signaling_heartbeat_tracked", "Sockets on the heartbeat timer wheel.",
+    lambda: [({}, len(heartbeat.wheel))])
+metrics.registry.counter_from(
+    "signaling_heartbeat_pings_total", "Heartbeat pings sent to silent sockets.",
+    lambda: [({}, heartbeat.pings)])
+metrics.registry.counter_from(
+    "signaling_heartbeat_reaped_total", "Sockets closed for missing heartbeats.",
+    lambda: [({}, heartbeat.reaped)])
+metrics.registry.counter_from(
+    "signaling_heartbeat_reap_batches_total", "Batches the reaped sockets were released in.",
+    lambda: [({}, heartbeat.reap_batches)])
+metrics.registry.gauge(
+    "signaling_deflate_sockets", "Open sockets with permessage-deflate negotiated.",
+    lambda: [({}, len(deflate_metrics.active))])
+metrics.registry.counter_from(
+    "signaling_deflate_messages_total", "Outbound messages compressed or sent raw under the threshold, and inbound messages inflated.",
+    lambda: [({"result": "compressed"}, deflate_metrics.compressed),
+             ({"result": "skipped"}, deflate_metrics.skipped),
+             ({"result": "inflated"}, deflate_metrics.inflated)])
+metrics.registry.counter_from(
+    "signaling_deflate_bytes_total", "Payload bytes before (raw) and after (wire) compression.",
+    lambda: [({"direction": "out", "form": "raw"}, deflate_metrics.raw_bytes),
+             ({"direction": "out", "form": "wire"}, deflate_metrics.wire_bytes),
+             ({"direction": "in", "form": "raw"}, deflate_metrics.inflated_raw_bytes),
+             ({"direction": "in", "form": "wire"}, deflate_metrics.inflated_wire_bytes)])
+metrics.registry.counter_from(
+    "signaling_deflate_seconds_total", "CPU time spent in zlib.",
+    lambda: [({"direction": "out"}, deflate_metrics.compress_seconds),
+             ({"direction": "in"}, deflate_metrics.decompress_seconds)])
+metrics.registry.gauge(
+    "signaling_admission_cache_entries", "Cached ValidateJoin results.",
+    lambda: [({}, len(grpc_client.admission.entries))])
+metrics.registry.counter_from(
+    "signaling_admission_cache_lookups_total", "Admission cache lookups by result.",
+    lambda: [({"result": "hit"}, grpc_client.admission.hits),
+             ({"result": "miss"}, grpc_client.admission.misses)])
+metrics.registry.counter_from(
+    "signaling_admission_cache_clears_total", "Times the admission cache was cleared.",
+    lambda: [({}, grpc_client.admission.clears)])
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats/queues")
+async def queue_stats():
+    return manager.get_queue_stats()
+
+@app.get("/stats/bus")
+async def bus_stats():
+    return redis_manager.get_shard_stats()
+
+@app.get("/route/{room_id}")
+async def route_room(room_id: int):
+    """Tells a client which node to open its WebSocket on, so a room's members share a node."""
+    node_id, url = await router.place(room_id)
+    if node_id is None:
+        return {"node": config.NODE_ID, "url": config.ADVERTISE_URL}
+    return {"node": node_id, "url": url}
+
+@app.get("/stats/routing")
+async def routing_stats():
+    return router.stats()
+
+@app.get("/stats/heartbeat")
+async def heartbeat_stats():
+    return heartbeat.stats()
+
+@app.get("/stats/ratelimit")
+async def ratelimit_stats():
+    return limiter.stats()
+
+@app.get("/stats/compression")
+async def compression_stats():
+    return deflate_metrics.stats()
+
+@app.get("/stats/admission")
+async def admission_stats():
+    return grpc_client.admission.stats()
+
+@app.get("/stats/traces")
+async def trace_dump(min_ms: float = 0, limit: int = 50, trace_id: str = None):
+    """Recent join traces kept by the sampler, newest first."""
+    return tracer.dump(min_ms=min_ms, limit=limit, trace_id=trace_id)
 
 @app.websocket("/ws/{room_id}/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, room_id: int, user_id: int):
-
-    await websocket.accept()
+    join = tracer.start("join", room_id=room_id, user_id=user_id, node=config.NODE_ID)
+    try:
+        await websocket_session(websocket, room_id, user_id, join)
+    except BaseException as e:
+        # A join that blew up (Redis, gRPC, codec...) is exactly the one worth keeping.
+        join.finish(outcome="error", error=type(e).__name__)
+        raise
+    finally:
+        # Every path that returns has already finished the join; this is a no-op then.
+        join.finish(outcome="error")
+
+async def websocket_session(websocket: WebSocket, room_id: int, user_id: int, join):
+
+    # Clients opt in to binary MessagePack frames via Sec-WebSocket-Protocol.
+    with tracer.span("accept"):
+        if codec.SUBPROTOCOL_MSGPACK in websocket.scope.get("subprotocols", []):
+            client_codec = codec.MSGPACK
+            await websocket.accept(subprotocol=codec.SUBPROTOCOL_MSGPACK)
+        else:
+            client_codec = codec.JSON
+            await websocket.accept()
+
+    if manager.draining:
+        join.finish(outcome="draining")
+        await websocket.close(code=1012, reason="Service Restart")
+        return
 
     try:
 
-        allowed, reason = await grpc_client.validate_join(user_id, room_id)
+        with tracer.span("validate_join"):
+            allowed, reason = await grpc_client.validate_join(user_id, room_id)
         if not allowed:
+            join.finish(outcome="denied", reason=reason)
             print(f"Join Denied for User {user_id}: {reason}")
             await websocket.close(code=1008, reason=reason)
             return
 
 
-        await manager.connect(websocket, room_id, user_id)
+        caps = frozenset(websocket.query_params.get("caps", "").split(","))
+        with tracer.span("connect"):
+            await manager.connect(websocket, room_id, user_id, client_codec, caps)
+        conn = manager.get_connection(websocket)
         
 
-        await redis_manager.subscribe(room_id)
+        with tracer.span("subscribe"):
+            await redis_manager.subscribe(room_id)
+        # Registers us and reads the whole room across the cluster in one round trip.
+        with tracer.span("join_presence") as span:
+            active_user_ids = await redis_manager.join_presence(room_id, user_id)
+            span.set(users=len(active_user_ids))
 
 
         try:
@@ -76,25 +418,47 @@ async def websocket_endpoint(websocket: WebSocket, room_id: int, user_id: int):
             print(f"gRPC Join/Update Error: {e}")
 
 
-        active_user_ids = manager.get_active_users(room_id)
-        await websocket.send_text(json.dumps({
-            "type": "existing_users",
-            "ids": active_user_ids
-        }))
+        with tracer.span("existing_users"):
+            manager.send_object(websocket, {
+                "type": "existing_users",
+                "ids": active_user_ids
+            })
 
 
-        await redis_manager.publish(room_id, {
-            "type": "user_joined",
-            "user_id": user_id
-        })
+        # The joiner learns about the others from existing_users, not from its own user_joined.
+        with tracer.span("publish_user_joined", shared=redis_manager.room_is_shared(room_id)):
+            await send_to_room(room_id, {
+                "type": "user_joined",
+                "user_id": user_id
+            }, exclude=websocket)
+        join.finish(outcome="joined")
 
 
         while True:
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            try:
+                message_data = codec.decode_frame(frame)
+            except codec.FrameError:
+                metrics.dropped_frames.inc()
+                continue
+            conn.received += 1
+            conn.last_seen = time.monotonic()
             
             msg_type = message_data.get("type")
 
+            throttle = limiter.check(conn, msg_type)
+            if throttle is not None:
+                scope, retry_after = throttle
+                if limiter.should_notify(conn, msg_type, retry_after):
+                    manager.send_object(websocket, {
+                        "type": "throttled",
+                        "msg_type": msg_type,
+                        "scope": scope,
+                        "retry_after_ms": math.ceil(retry_after * 1000) if math.isfinite(retry_after) else None
+                    })
+                continue
 
             if msg_type == "chat":
                 content = message_data.get("content")
@@ -105,7 +469,7 @@ async def websocket_endpoint(websocket: WebSocket, room_id: int, user_id: int):
                     "user_id": user_id,
                     "content": content
                 }
-                await redis_manager.publish(room_id, payload)
+                await send_to_room(room_id, payload)
                 
                 
                 try:
@@ -114,6 +478,9 @@ async def websocket_endpoint(websocket: WebSocket, room_id: int, user_id: int):
                      print(f"gRPC Store Message Error: {e}")
 
             
+            elif msg_type == "candidate" and config.CANDIDATE_WINDOW_MS > 0 and str(message_data.get("target_id")).isdigit():
+                coalescer.add(room_id, user_id, int(message_data["target_id"]), message_data.get("data"))
+
             elif msg_type in ["offer", "answer", "candidate"]:
                 
                 payload = {
@@ -122,28 +489,47 @@ async def websocket_endpoint(websocket: WebSocket, room_id: int, user_id: int):
                     "target_id": message_data.get("target_id"),
                     "data": message_data.get("data")
                 }
-
-                await redis_manager.publish(room_id, payload)
+                await route_signal(room_id, payload)
 
     except WebSocketDisconnect:
+        join.finish(outcome="disconnected")
+
+        if websocket in manager.reaped:
+            # The heartbeat already ran the leave path for this socket.
+            manager.reaped.discard(websocket)
+            return
 
         print(f"User {user_id} disconnected")
         manager.disconnect(websocket)
-        
+
+        if manager.draining:
+            # Presence is released in one batch once the drain is over.
+            if not manager.has_user(room_id, user_id):
+                manager.drained.add((room_id, user_id))
+            if manager.get_room_count(room_id) == 0:
+                await redis_manager.unsubscribe(room_id)
+                await router.release_room(room_id)
+            return
+
+        # Users still here in another tab, or who already rejoined on
+        # another node, don't get a user_left.
+        if not manager.has_user(room_id, user_id) and await redis_manager.leave_presence(room_id, user_id):
+            # Announce before unsubscribing: once we leave the room we no longer
+            # know which other nodes hold it.
+            await send_to_room(room_id, {
+                "type": "user_left",
+                "user_id": user_id
+            })
 
         if manager.get_room_count(room_id) == 0:
             await redis_manager.unsubscribe(room_id)
+            await router.release_room(room_id)
 
         try:
             await grpc_client.user_left(user_id, room_id)
         except Exception as e:
             print(f"gRPC Leave Error: {e}")
-            
-
-        await redis_manager.publish(room_id, {
-            "type": "user_left",
-            "user_id": user_id
-        })
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host=config.HOST, port=config.PORT, reload=True)
+    uvicorn.run("main:app", host=config.HOST, port=config.PORT, reload=True,
+                ws=DeflateWebSocketProtocol, ws_per_message_deflate=config.WS_DEFLATE)
@@ -0,0 +1,164 @@
+"""Prometheus metrics for the signaling node, cheap enough to leave on.
+
+Every series is created at import with its labels already rendered, so the
+hot paths only bump an attribute or bisect into a pre-allocated bucket list:
+nothing is allocated per message and nothing is locked, since the node is a
+single event loop. State that already lives elsewhere (sockets per room, the
+counters behind the /stats endpoints) is read from its owner only when
+/metrics is scraped.
+"""
+import asyncio
+import bisect
+
+import config
+
+# Seconds; spans a sub-millisecond local hop up to a stalled dependency.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+GRPC_METHODS = ("ValidateJoin", "UserJoined", "UserLeft", "StoreMessage")
+SEND_FAILURE_KINDS = ("timeout", "overflow", "error")
+
+
+def _labels(**labels) -> str:
+    labels = {"node": config.NODE_ID, **labels}
+    return ",".join(f'{key}="{value}"' for key, value in labels.items())
+
+
+class Counter:
+    __slots__ = ("labels", "value")
+
+    def __init__(self, labels: str):
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self, name: str, out: list):
+        out.append(f"{name}{{{self.labels}}} {self.value}")
+
+
+class Histogram:
+    __slots__ = ("labels", "bounds", "counts", "sum", "count")
+
+    def __init__(self, labels: str, bounds: tuple):
+        self.labels = labels
+        self.bounds = bounds
+        # One slot per bound plus +Inf; cumulated only when rendered.
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, out: list):
+        cumulative = 0
+        for bound, n in zip(self.bounds, self.counts):
+            cumulative += n
+            out.append(f'{name}_bucket{{{self.labels},le="{bound}"}} {cumulative}')
+        out.append(f'{name}_bucket{{{self.labels},le="+Inf"}} {self.count}')
+        out.append(f"{name}_sum{{{self.labels}}} {self.sum}")
+        out.append(f"{name}_count{{{self.labels}}} {self.count}")
+
+
+class Registry:
+    """Metric families in registration order, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.families = []
+
+    def counter(self, name: str, help: str, **labels) -> Counter:
+        return self._add(name, help, "counter", Counter(_labels(**labels)))
+
+    def histogram(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS, **labels) -> Histogram:
+        return self._add(name, help, "histogram", Histogram(_labels(**labels), buckets))
+
+    def gauge(self, name: str, help: str, collect):
+        """collect() -> iterable of (labels dict, value), called at scrape time."""
+        self.families.append((name, help, "gauge", collect))
+
+    def counter_from(self, name: str, help: str, collect):
+        """Like gauge(), for a running total that another component already keeps."""
+        self.families.append((name, help, "counter", collect))
+
+    def _add(self, name: str, help: str, kind: str, series):
+        for family in self.families:
+            if family[0] == name:
+                family[3].append(series)
+                return series
+        self.families.append((name, help, kind, [series]))
+        return series
+
+    def render(self) -> str:
+        out = []
+        for name, help, kind, series in self.families:
+            out.append(f"# HELP {name} {help}")
+            out.append(f"# TYPE {name} {kind}")
+            if callable(series):
+                for labels, value in series():
+                    out.append(f"{name}{{{_labels(**labels)}}} {value}")
+            else:
+                for s in series:
+                    s.render(name, out)
+        out.append("")
+        return "\n".join(out)
+
+
+registry = Registry()
+
+redis_publish_seconds = registry.histogram(
+    "signaling_redis_publish_seconds", "Time to publish one message to the Redis bus.")
+redis_listener_seconds = registry.histogram(
+    "signaling_redis_listener_seconds", "Time to dispatch one message received from the Redis bus.")
+fanout_seconds = registry.histogram(
+    "signaling_fanout_seconds", "Time for broadcast_to_room to queue a message for every local socket in a room.")
+grpc_seconds = {
+    method: registry.histogram("signaling_grpc_seconds", "ManagementService call latency, retries included.", method=method)
+    for method in GRPC_METHODS
+}
+grpc_errors = {
+    method: registry.counter("signaling_grpc_errors_total", "ManagementService calls that failed after retries.", method=method)
+    for method in GRPC_METHODS
+}
+send_failures = {
+    kind: registry.counter("signaling_send_failures_total", "Sockets detached because a send failed, timed out or overflowed.", kind=kind)
+    for kind in SEND_FAILURE_KINDS
+}
+dropped_frames = registry.counter(
+    "signaling_dropped_frames_total", "Client frames dropped because they could not be decoded.")
+loop_lag_seconds = registry.histogram(
+    "signaling_event_loop_lag_seconds", "How late the loop-lag monitor woke up.", buckets=LOOP_LAG_BUCKETS)
+
+
+class LoopLagMonitor:
+    """Sleeps LOOP_LAG_INTERVAL at a time and records how late each wakeup was.
+
+    Anything that blocks the event loop (a slow callback, a big JSON payload,
+    GC) shows up directly as lag.
+    """
+
+    def __init__(self):
+        self.task = None
+        self.last = 0.0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + config.LOOP_LAG_INTERVAL
+            await asyncio.sleep(config.LOOP_LAG_INTERVAL)
+            self.last = max(0.0, loop.time() - expected)
+            loop_lag_seconds.observe(self.last)
+
+
+loop_lag = LoopLagMonitor()
+registry.gauge(
+    "signaling_event_loop_lag_last_seconds", "Lag of the most recent loop-lag sample.",
+    lambda: [({}, loop_lag.last)])
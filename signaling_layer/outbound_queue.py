@@ -0,0 +1,91 @@
+import asyncio
+import collections
+
+from fastapi import WebSocket
+
+import config
+
+# Delivery policies for a single outbound message.
+DROP_OLDEST = "drop_oldest"   # chat: under pressure the oldest queued chat line goes first
+NEVER_DROP = "never_drop"     # signaling: losing an offer/answer/candidate breaks the call
+
+
+class OutboundQueue:
+    """Bounded per-connection send queue drained by its own writer task.
+
+    put() never awaits, so the Redis listener can hand a message to every socket
+    in a room without waiting on any of them. When the queue is full, the oldest
+    droppable message is evicted to make room. Never-drop messages are still
+    queued past the bound, but each time that happens counts as an overflow;
+    after SEND_QUEUE_MAX_OVERFLOWS overflows without the queue draining, put()
+    reports the connection as unhealthy so the caller can disconnect it.
+    """
+
+    __slots__ = ("websocket", "on_failure", "items", "writer_task", "dropped", "overflows", "sent")
+
+    def __init__(self, websocket: WebSocket, on_failure):
+        self.websocket = websocket
+        self.on_failure = on_failure
+        # The deque and writer task only exist while there is something to
+        # send, so idle connections cost a few slots instead of a task.
+        self.items = None
+        self.writer_task = None
+
+        self.dropped = 0
+        self.overflows = 0
+        self.sent = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self.items) if self.items else 0
+
+    def close(self):
+        if self.writer_task and self.writer_task is not asyncio.current_task():
+            self.writer_task.cancel()
+        self.writer_task = None
+        self.items = None
+
+    def put(self, message, policy: str = NEVER_DROP) -> bool:
+        """Queues a message. Returns False once the connection has overflowed too often."""
+        if self.items is None:
+            self.items = collections.deque()
+        elif len(self.items) >= config.SEND_QUEUE_SIZE:
+            self.overflows += 1
+            if not self._evict_oldest_droppable():
+                if policy == DROP_OLDEST:
+                    # Nothing older is droppable, so the newest chat line goes instead.
+                    self.dropped += 1
+                    return self.overflows < config.SEND_QUEUE_MAX_OVERFLOWS
+            if self.overflows >= config.SEND_QUEUE_MAX_OVERFLOWS:
+                return False
+
+        self.items.append((message, policy))
+        if self.writer_task is None:
+            self.writer_task = asyncio.create_task(self._writer())
+        return True
+
+    def _evict_oldest_droppable(self) -> bool:
+        for i, (_, policy) in enumerate(self.items):
+            if policy == DROP_OLDEST:
+                del self.items[i]
+                self.dropped += 1
+                return True
+        return False
+
+    async def _writer(self):
+        while self.items:
+            message, _ = self.items.popleft()
+            send = self.websocket.send_bytes(message) if isinstance(message, bytes) else self.websocket.send_text(message)
+            try:
+                await asyncio.wait_for(send, timeout=config.SEND_TIMEOUT)
+                self.sent += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.on_failure(self.websocket, e)
+                return
+
+        # Drained: the client has caught up, so forgive earlier overflows.
+        self.overflows = 0
+        self.items = None
+        self.writer_task = None
@@ -0,0 +1,121 @@
+import math
+import time
+from typing import Dict, Tuple
+
+import config
+
+CONNECTION = "connection"
+ROOM = "room"
+
+
+class TokenBucket:
+    """Refills at `rate` tokens per second up to `burst`; each message takes one token."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now: float) -> bool:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def retry_after(self) -> float:
+        """Seconds until the next token is available; inf for a type limited to 0."""
+        if self.rate <= 0:
+            return math.inf
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """Token buckets on inbound client messages, per connection and per room.
+
+    Limits are set per message type (RATE_LIMITS / ROOM_RATE_LIMITS); types
+    without a limit are not metered. A message has to fit both its
+    connection's bucket and its room's bucket on this node, and is checked
+    before anything is published or stored. Room buckets are dropped when the
+    room's last local member leaves.
+    """
+
+    def __init__(self):
+        # room_id -> msg_type -> bucket
+        self.room_buckets: Dict[int, Dict[str, TokenBucket]] = {}
+
+        self.allowed = 0
+        # (scope, msg_type) -> messages rejected
+        self.throttled: Dict[Tuple[str, str], int] = {}
+        self.notices = 0
+
+    def check(self, conn, msg_type: str):
+        """Returns None if the message may proceed, else (scope, retry_after_seconds)."""
+        if not isinstance(msg_type, str):
+            return None
+        conn_limit = config.RATE_LIMITS.get(msg_type)
+        room_limit = config.ROOM_RATE_LIMITS.get(msg_type)
+        if conn_limit is None and room_limit is None:
+            return None
+
+        now = time.monotonic()
+        conn_bucket = None
+        if conn_limit is not None:
+            conn_bucket = conn.buckets.get(msg_type)
+            if conn_bucket is None:
+                conn_bucket = conn.buckets[msg_type] = TokenBucket(*conn_limit, now)
+            if not conn_bucket.take(now):
+                return self._reject(CONNECTION, msg_type, conn_bucket)
+
+        if room_limit is not None:
+            buckets = self.room_buckets.setdefault(conn.room_id, {})
+            room_bucket = buckets.get(msg_type)
+            if room_bucket is None:
+                room_bucket = buckets[msg_type] = TokenBucket(*room_limit, now)
+            if not room_bucket.take(now):
+                # The room is the bottleneck, so don't charge the sender's own bucket too.
+                if conn_bucket is not None:
+                    conn_bucket.refund()
+                return self._reject(ROOM, msg_type, room_bucket)
+
+        self.allowed += 1
+        return None
+
+    def _reject(self, scope: str, msg_type: str, bucket: TokenBucket):
+        key = (scope, msg_type)
+        self.throttled[key] = self.throttled.get(key, 0) + 1
+        return scope, bucket.retry_after()
+
+    def should_notify(self, conn, msg_type: str, retry_after: float) -> bool:
+        """One throttle notice per type per throttled stretch, not one per dropped message.
+
+        A type limited to 0 never refills, so it is announced once per connection.
+        """
+        now = time.monotonic()
+        if now < conn.throttled_until.get(msg_type, 0.0):
+            return False
+        conn.throttled_until[msg_type] = now + retry_after
+        self.notices += 1
+        return True
+
+    def forget_room(self, room_id: int):
+        self.room_buckets.pop(room_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "allowed": self.allowed,
+            "throttled": {f"{scope}:{msg_type}": n for (scope, msg_type), n in sorted(self.throttled.items())},
+            "throttled_total": sum(self.throttled.values()),
+            "notices": self.notices,
+            "rooms_metered": len(self.room_buckets),
+        }
+
+
+limiter = RateLimiter()
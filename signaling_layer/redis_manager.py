@@ -1,59 +1,549 @@
 import redis.asyncio as redis
+from redis.asyncio.retry import Retry
+from redis.backoff import NoBackoff
 import config
 import asyncio
 import json
+import time
+import zlib
+from contextlib import asynccontextmanager
+
+import codec
+import envelope
+import metrics
+
+# Deletes the user's home-node entry only if it still points at this node,
+# so a leave on one node cannot erase a newer registration from another.
+UNREGISTER_USER_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+class PubSubShard:
+    """One pub/sub connection and its listener task, with per-shard counters.
+
+    `channels` is the source of truth for what this shard should be
+    subscribed to, so a fresh connection can be brought back to the same
+    state after Redis restarts.
+    """
+
+    def __init__(self, index: int, client):
+        self.index = index
+        self.client = client
+        self.pubsub = client.pubsub()
+        self.channels = set()
+        self.control_channels = set()
+        self.task = None
+        # Serializes commands on the connection, including the first one:
+        # concurrent first commands on a PubSub each open a connection and
+        # one of them is lost.
+        self.lock = asyncio.Lock()
+        self.active = asyncio.Event()
+
+        self.messages = 0
+        self.errors = 0
+        self.resubscribes = 0
+        self.last_recovery_ms = None
+
+    async def subscribe(self, channel: str, control: bool = False):
+        async with self.lock:
+            (self.control_channels if control else self.channels).add(channel)
+            await self.pubsub.subscribe(channel)
+        self.active.set()
+
+    async def unsubscribe(self, channel: str):
+        async with self.lock:
+            self.channels.discard(channel)
+            await self.pubsub.unsubscribe(channel)
+
+    async def resubscribe(self):
+        """Replaces the connection and restores every tracked channel in one command each."""
+        async with self.lock:
+            old, self.pubsub = self.pubsub, self.client.pubsub()
+            try:
+                await old.aclose()
+            except Exception:
+                pass
+            if self.control_channels:
+                await self.pubsub.subscribe(*self.control_channels)
+            if self.channels:
+                await self.pubsub.subscribe(*self.channels)
+
+    def stats(self) -> dict:
+        return {
+            "shard": self.index,
+            "channels": len(self.channels),
+            "messages": self.messages,
+            "errors": self.errors,
+            "resubscribes": self.resubscribes,
+            "last_recovery_ms": self.last_recovery_ms,
+        }
+
 
 class RedisManager:
     def __init__(self):
-        self.redis = redis.from_url(config.REDIS_URL, encoding="utf-8", decode_responses=True)
-        self.pubsub = self.redis.pubsub()
+        # Payloads may be MessagePack, so the bus works in raw bytes.
+        # Bursts of joins and leaves wait for a pooled connection rather than
+        # failing with "Too many connections" once the pool is exhausted.
+        self.redis = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
+            config.REDIS_URL,
+            max_connections=config.REDIS_POOL_SIZE,
+            timeout=config.REDIS_POOL_TIMEOUT,
+        ))
+        # Listener connections don't retry internally: redis-py would silently
+        # reconnect and resubscribe, hiding the gap from us and from clients.
+        self.listener_redis = redis.from_url(config.REDIS_URL, retry=Retry(NoBackoff(), 0))
+        self.bus_codec = codec.CODECS[config.BUS_CODEC]
+        self.shards = [PubSubShard(i, self.listener_redis) for i in range(config.PUBSUB_SHARDS)]
         self.broadcast_callback = None
+        self.gap_callback = None
+        self.control_gap_callback = None
         self.is_listening = False
         self.subscribed_rooms = set()
+        # room_id -> [lock, holders]: serializes subscribe/unsubscribe of one
+        # room, so a leave and a rejoin can't interleave their awaits.
+        self.room_locks = {}
+        # room_id -> ids of the other nodes holding members of the room. When
+        # it is empty, room messages are delivered locally and never published.
+        self.remote_nodes = {}
+        # Joins waiting for the next pipelined presence write.
+        self._pending_joins = []
+        self._join_flush = None
+        self.node_channel = f"node:{config.NODE_ID}"
+        self.heartbeat_task = None
+        self.status_callback = None
+        self._unregister_user = self.redis.register_script(UNREGISTER_USER_SCRIPT)
+
+    @asynccontextmanager
+    async def _room_transition(self, room_id: int):
+        entry = self.room_locks.get(room_id)
+        if entry is None:
+            entry = self.room_locks[room_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.room_locks[room_id]
+
+    def _shard_for(self, channel: str) -> PubSubShard:
+        return self.shards[zlib.crc32(channel.encode()) % len(self.shards)]
 
     async def connect(self):
         if not self.is_listening:
             self.is_listening = True
-            asyncio.create_task(self._listener_loop())
+            await self.shards[0].subscribe("global_control", control=True)
+            await self._shard_for(self.node_channel).subscribe(self.node_channel)
+            for shard in self.shards:
+                shard.task = asyncio.create_task(self._listener_loop(shard))
+            self.heartbeat_task = asyncio.create_task(self._heartbeat_loop())
 
-    async def _listener_loop(self):
-        """Internal loop to consume messages."""
-        async with self.pubsub as pb:
-           
-            await pb.subscribe("global_control")
-            
-            while True:
-                try:
-                    message = await pb.get_message(ignore_subscribe_messages=True, timeout=1.0)
-                    if message and message['type'] == 'message':
+    async def heartbeat(self):
+        """Refreshes node_alive:{NODE_ID} with this node's URL and current status."""
+        status = self.status_callback() if self.status_callback else {}
+        status["url"] = config.ADVERTISE_URL
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(f"node_alive:{config.NODE_ID}", json.dumps(status), ex=config.NODE_TTL)
+            pipe.sadd("signaling_nodes", config.NODE_ID)
+            # Our presence sets live exactly as long as our heartbeat does.
+            for room_id in self.subscribed_rooms:
+                pipe.expire(self._presence_key(room_id, config.NODE_ID), config.NODE_TTL)
+            await pipe.execute()
+
+    async def _heartbeat_loop(self):
+        """Keeps node_alive:{NODE_ID} set while this node is up."""
+        while True:
+            try:
+                await self.heartbeat()
+                await self.prune_room_nodes()
+            except Exception as e:
+                print(f"Node heartbeat failed: {e}")
+            await asyncio.sleep(config.NODE_HEARTBEAT_INTERVAL)
+
+    async def _listener_loop(self, shard: PubSubShard):
+        """Consumes one shard's messages as Redis pushes them.
+
+        On any connection error the shard is rebuilt with all its channels
+        restored, and the rooms on it are reported through gap_callback since
+        pub/sub messages published in the meantime are gone.
+        """
+        while True:
+            try:
+                await shard.active.wait()
+                async for message in shard.pubsub.listen():
+                    if message['type'] == 'message':
+                        shard.messages += 1
                         if self.broadcast_callback:
-                            await self.broadcast_callback(message['channel'], message['data'])
-                except Exception as e:
-                    print(f"Redis Error: {e}")
-                    await asyncio.sleep(1)
+                            start = time.perf_counter()
+                            await self.broadcast_callback(message['channel'].decode(), message['data'])
+                            metrics.redis_listener_seconds.observe(time.perf_counter() - start)
+                # listen() returns once the connection has no subscriptions left.
+                if not shard.channels and not shard.control_channels:
+                    shard.active.clear()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                shard.errors += 1
+                print(f"Redis Error on shard {shard.index}: {e}")
+                await self._recover(shard)
+
+    async def _recover(self, shard: PubSubShard):
+        start = time.monotonic()
+        delay = config.PUBSUB_RECONNECT_BACKOFF
+        while True:
+            try:
+                await shard.resubscribe()
+                break
+            except Exception as e:
+                print(f"Redis resubscribe failed on shard {shard.index}: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, config.PUBSUB_RECONNECT_BACKOFF_MAX)
+
+        shard.resubscribes += 1
+        shard.last_recovery_ms = round((time.monotonic() - start) * 1000, 1)
+        print(f"Shard {shard.index} resubscribed {len(shard.channels)} channels in {shard.last_recovery_ms}ms")
+
+        if shard.control_channels and self.control_gap_callback:
+            await self.control_gap_callback()
+        room_ids = [int(ch.split(":")[1]) for ch in shard.channels if ch.startswith("room:")]
+        if room_ids and self.gap_callback:
+            await self.gap_callback(room_ids)
+
+    def get_shard_stats(self) -> list:
+        return [shard.stats() for shard in self.shards]
 
     async def set_callback(self, callback):
         self.broadcast_callback = callback
 
+    async def set_status_callback(self, callback):
+        """callback() -> dict, merged into every heartbeat."""
+        self.status_callback = callback
+
+    async def set_gap_callback(self, callback):
+        self.gap_callback = callback
+
+    async def set_control_gap_callback(self, callback):
+        """Async callback() run after the global_control channel may have missed messages."""
+        self.control_gap_callback = callback
+
+    def _pack(self, room_id: int, target_id, message: dict) -> bytes:
+        return envelope.pack(message["type"], config.NODE_ID, room_id, target_id, self.bus_codec, codec.encode(message, self.bus_codec))
+
+    async def _send(self, channel: str, data: bytes):
+        start = time.perf_counter()
+        await self.redis.publish(channel, data)
+        metrics.redis_publish_seconds.observe(time.perf_counter() - start)
+
     async def publish(self, room_id: int, message: dict):
-        channel = f"room:{room_id}"
-        await self.redis.publish(channel, json.dumps(message))
+        await self._send(f"room:{room_id}", self._pack(room_id, None, message))
 
-    async def subscribe(self, room_id: int):
-        if room_id in self.subscribed_rooms:
+    async def publish_encoded(self, room_id: int, msg_type: str, payload: bytes):
+        """Publishes a payload already encoded with bus_codec."""
+        await self._send(f"room:{room_id}", envelope.pack(msg_type, config.NODE_ID, room_id, None, self.bus_codec, payload))
+
+    def room_is_shared(self, room_id: int) -> bool:
+        return bool(self.remote_nodes.get(room_id))
+
+    def note_room_node(self, room_id: int, node_id: str, present: bool):
+        """Applies another node's room_node_enter/room_node_leave announcement."""
+        if room_id not in self.subscribed_rooms or node_id == config.NODE_ID:
             return
-        
-        channel = f"room:{room_id}"
-        print(f"Subscribing to Redis : {channel}")
-        await self.pubsub.subscribe(channel)
-        self.subscribed_rooms.add(room_id)
+        if present:
+            self.remote_nodes.setdefault(room_id, set()).add(node_id)
+        else:
+            self.remote_nodes.get(room_id, set()).discard(node_id)
+
+    async def _enter_room(self, room_id: int):
+        """Joins room_nodes:{room}, learns who else holds the room, and tells them we're here.
+
+        Called after subscribing, so an announcement from a node joining at the
+        same moment is received rather than missed.
+        """
+        key = f"room_nodes:{room_id}"
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.sadd(key, config.NODE_ID)
+            pipe.smembers(key)
+            _, members = await pipe.execute()
+        others = {m.decode() for m in members} - {config.NODE_ID}
+        others -= await self._drop_dead_nodes({room_id: others})
+        self.remote_nodes.setdefault(room_id, set()).update(others)
+        await self.publish(room_id, {"type": "room_node_enter"})
+
+    async def _leave_room(self, room_id: int):
+        self.remote_nodes.pop(room_id, None)
+        await self.redis.srem(f"room_nodes:{room_id}", config.NODE_ID)
+        await self.publish(room_id, {"type": "room_node_leave"})
+
+    async def refresh_room_nodes(self, room_ids: list):
+        """Re-reads room membership after a bus gap, where announcements may have been missed."""
+        room_ids = [r for r in room_ids if r in self.subscribed_rooms]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for room_id in room_ids:
+                pipe.smembers(f"room_nodes:{room_id}")
+            results = await pipe.execute()
+        rooms = {room_id: {m.decode() for m in members} - {config.NODE_ID} for room_id, members in zip(room_ids, results)}
+        dead = await self._drop_dead_nodes(rooms)
+        for room_id, ids in rooms.items():
+            self.remote_nodes[room_id] = ids - dead
+
+    async def _drop_dead_nodes(self, rooms: dict) -> set:
+        """Removes nodes without a node_alive key from room_nodes:{room} for {room_id: node_ids}.
+
+        A node that crashed never sends room_node_leave, so this is how it
+        leaves the room, like AffinityRouter.live_nodes does for
+        signaling_nodes. Returns the dead node ids.
+        """
+        node_ids = list(set().union(*rooms.values()))
+        if not node_ids:
+            return set()
+        values = await self.redis.mget([f"node_alive:{n}" for n in node_ids])
+        dead = {n for n, value in zip(node_ids, values) if value is None}
+        if dead:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for room_id, ids in rooms.items():
+                    if ids & dead:
+                        pipe.srem(f"room_nodes:{room_id}", *(ids & dead))
+                await pipe.execute()
+        return dead
+
+    async def prune_room_nodes(self):
+        """Forgets remote nodes whose heartbeat expired, so their rooms can go back to local delivery."""
+        dead = await self._drop_dead_nodes({room_id: set(ids) for room_id, ids in self.remote_nodes.items()})
+        for ids in self.remote_nodes.values():
+            ids -= dead
+
+    async def publish_to_node(self, node_id: str, room_id: int, target_id: int, message: dict):
+        await self._send(f"node:{node_id}", self._pack(room_id, target_id, message))
+
+    @staticmethod
+    def _presence_key(room_id: int, node_id: str) -> str:
+        return f"presence:{room_id}:{node_id}"
+
+    def _presence_keys(self, room_id: int) -> list:
+        nodes = {config.NODE_ID} | self.remote_nodes.get(room_id, set())
+        return [self._presence_key(room_id, node_id) for node_id in nodes]
+
+    async def register_users(self, room_id: int, user_ids: list):
+        """Records this node as the home node of the users and adds them to the room's presence."""
+        if not user_ids:
+            return
+        key = self._presence_key(room_id, config.NODE_ID)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(f"user_node:{room_id}", mapping={user_id: config.NODE_ID for user_id in user_ids})
+            pipe.sadd(key, *user_ids)
+            pipe.expire(key, config.NODE_TTL)
+            await pipe.execute()
+
+    async def join_presence(self, room_id: int, user_id: int) -> list:
+        """Registers the user and returns every user in the room across the cluster.
+
+        Presence is one set per (room, node), expiring with the node's
+        heartbeat, so a dead node's users disappear on their own. Joins that
+        arrive in the same loop iteration share one pipeline, and each join's
+        snapshot is a single SUNION over the nodes known to hold the room.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending_joins.append((room_id, user_id, future))
+        if self._join_flush is None:
+            self._join_flush = asyncio.create_task(self._flush_joins())
+        return await future
+
+    async def _flush_joins(self):
+        await asyncio.sleep(0)
+        batch, self._pending_joins = self._pending_joins, []
+        self._join_flush = None
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for room_id, user_id, _ in batch:
+                    key = self._presence_key(room_id, config.NODE_ID)
+                    pipe.hset(f"user_node:{room_id}", user_id, config.NODE_ID)
+                    pipe.sadd(key, user_id)
+                    pipe.expire(key, config.NODE_TTL)
+                # Snapshots go after every write, so joiners in the same batch
+                # see each other, and one snapshot serves every joiner of a room.
+                rooms = list(dict.fromkeys(room_id for room_id, _, _ in batch))
+                for room_id in rooms:
+                    pipe.sunion(self._presence_keys(room_id))
+                results = await pipe.execute()
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        snapshots = {
+            room_id: sorted(int(m) for m in members)
+            for room_id, members in zip(rooms, results[-len(rooms):])
+        }
+        for room_id, _, future in batch:
+            if not future.done():
+                future.set_result(list(snapshots[room_id]))
+
+    async def leave_presence(self, room_id: int, user_id: int) -> bool:
+        """Drops the user from this node's presence and its home-node entry, in one round trip.
+
+        Returns False if the home-node entry already pointed elsewhere, i.e.
+        the user has rejoined on another node.
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.srem(self._presence_key(room_id, config.NODE_ID), user_id)
+            await self._unregister_user(keys=[f"user_node:{room_id}"], args=[user_id, config.NODE_ID], client=pipe)
+            _, removed = await pipe.execute()
+        return bool(removed)
+
+    async def release_users(self, pairs) -> list:
+        """Unregisters many users in one pipeline.
+
+        Returns the (room_id, user_id) pairs whose home was still this node,
+        i.e. the users who have not already rejoined somewhere else.
+        """
+        pairs = list(pairs)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for room_id, user_id in pairs:
+                await self._unregister_user(keys=[f"user_node:{room_id}"], args=[user_id, config.NODE_ID], client=pipe)
+            for room_id, user_id in pairs:
+                pipe.srem(self._presence_key(room_id, config.NODE_ID), user_id)
+            results = await pipe.execute()
+        return [pair for pair, removed in zip(pairs, results) if removed]
+
+    async def close(self):
+        """Stops the heartbeat and drops the liveness key so the node's occupancy is reaped right away."""
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+        try:
+            await self.redis.delete(f"node_alive:{config.NODE_ID}")
+            await self.redis.srem("signaling_nodes", config.NODE_ID)
+        except Exception as e:
+            print(f"Failed to clear node heartbeat: {e}")
+
+    async def get_user_node(self, room_id: int, user_id: int):
+        node_id = await self.redis.hget(f"user_node:{room_id}", user_id)
+        return node_id.decode() if node_id else None
+
+    async def subscribe(self, room_id: int):
+        async with self._room_transition(room_id):
+            if room_id in self.subscribed_rooms:
+                return
 
-    async def unsubscribe(self, room_id: int):
-        if room_id in self.subscribed_rooms:
             channel = f"room:{room_id}"
-            print(f"Unsubscribing from Redis : {channel}")
-            await self.pubsub.unsubscribe(channel)
-            self.subscribed_rooms.remove(room_id)
+            print(f"Subscribing to Redis : {channel}")
+            self.subscribed_rooms.add(room_id)
+            await self._shard_for(channel).subscribe(channel)
+            await self._enter_room(room_id)
+
+    async def unsubscribe(self, room_id: int):
+        async with self._room_transition(room_id):
+            if room_id in self.subscribed_rooms:
+                channel = f"room:{room_id}"
+                print(f"Unsubscribing from Redis : {channel}")
+                self.subscribed_rooms.discard(room_id)
+                await self._leave_room(room_id)
+                await self._shard_for(channel).unsubscribe(channel)
+
+
+class StreamsRedisManager(RedisManager):
+    """Room bus on Redis Streams instead of pub/sub.
+
+    Every room (and this node's unicast inbox) is a stream capped with
+    MAXLEN ~ STREAM_MAXLEN. One reader task per node does a blocking XREAD
+    over all tracked streams and remembers the last delivered ID of each, so
+    after a connection blip it resumes where it left off and replays whatever
+    was added in the meantime, up to the trim length.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.last_ids = {}
+        self.listener_task = None
+
+    async def connect(self):
+        if not self.is_listening:
+            self.is_listening = True
+            await self._track(f"stream:{self.node_channel}")
+            await self._track("stream:global_control")
+            self.listener_task = asyncio.create_task(self._listener_loop())
+            self.heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    async def _track(self, key: str):
+        # Start from the current tail rather than "$", so nothing published
+        # between now and the reader's next XREAD is skipped. The reader picks
+        # the new stream up within STREAM_BLOCK_MS.
+        latest = await self.redis.xrevrange(key, count=1)
+        self.last_ids[key] = latest[0][0] if latest else b"0-0"
+
+    async def _listener_loop(self):
+        """Internal loop to consume messages."""
+        recovering = False
+        while True:
+            try:
+                if recovering:
+                    # Control entries are replayed from last_ids, but may have been trimmed.
+                    if self.control_gap_callback:
+                        await self.control_gap_callback()
+                    await self._check_trimmed()
+                    recovering = False
+                response = await self.redis.xread(dict(self.last_ids), count=config.STREAM_READ_COUNT, block=config.STREAM_BLOCK_MS)
+                for key, entries in response or []:
+                    key = key.decode()
+                    for entry_id, fields in entries:
+                        if key not in self.last_ids:
+                            break
+                        self.last_ids[key] = entry_id
+                        if self.broadcast_callback:
+                            start = time.perf_counter()
+                            await self.broadcast_callback(key[len("stream:"):], fields[b"d"])
+                            metrics.redis_listener_seconds.observe(time.perf_counter() - start)
+            except Exception as e:
+                print(f"Redis Error: {e}")
+                recovering = True
+                await asyncio.sleep(1)
+
+    async def _check_trimmed(self):
+        """Reports rooms whose stream was trimmed (or lost) past our last delivered ID.
+
+        If the last entry we delivered is no longer in the stream, entries
+        after it may have been trimmed before we could read them.
+        """
+        keys = [key for key in self.last_ids if key.startswith("stream:room:") and self.last_ids[key] != b"0-0"]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.xrange(key, min=self.last_ids[key], max=self.last_ids[key], count=1)
+            found = await pipe.execute()
+
+        gaps = [int(key.rsplit(":", 1)[1]) for key, entry in zip(keys, found) if not entry]
+        if gaps and self.gap_callback:
+            await self.gap_callback(gaps)
+
+    async def _send(self, channel: str, data: bytes):
+        start = time.perf_counter()
+        key = f"stream:{channel}"
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.xadd(key, {"d": data}, maxlen=config.STREAM_MAXLEN, approximate=True)
+            pipe.expire(key, config.STREAM_TTL)
+            await pipe.execute()
+        metrics.redis_publish_seconds.observe(time.perf_counter() - start)
+
+    async def subscribe(self, room_id: int):
+        async with self._room_transition(room_id):
+            if room_id in self.subscribed_rooms:
+                return
+
+            self.subscribed_rooms.add(room_id)
+            print(f"Subscribing to Redis stream : room:{room_id}")
+            await self._track(f"stream:room:{room_id}")
+            await self._enter_room(room_id)
+
+    async def unsubscribe(self, room_id: int):
+        async with self._room_transition(room_id):
+            if room_id in self.subscribed_rooms:
+                print(f"Unsubscribing from Redis stream : room:{room_id}")
+                self.subscribed_rooms.discard(room_id)
+                await self._leave_room(room_id)
+                self.last_ids.pop(f"stream:room:{room_id}", None)
 
 
-redis_manager = RedisManager()
+redis_manager = StreamsRedisManager() if config.BUS_BACKEND == "streams" else RedisManager()
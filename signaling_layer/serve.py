@@ -0,0 +1,112 @@
+"""Production launcher: N signaling workers sharing one port via SO_REUSEPORT.
+
+Every worker is a separate process and a separate node in the cluster, with
+its own NODE_ID, ConnectionManager, Redis subscriptions and node channel. The
+kernel spreads incoming connections across the workers' listening sockets.
+Workers that die are replaced under a fresh node ID, so the management layer
+reaps the old one's occupancy instead of merging it into the new one.
+
+SIGTERM drains each worker (see main.drain_node) before it exits.
+
+    SIGNALING_WORKERS=4 python serve.py
+"""
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import uuid
+
+import uvicorn
+
+import config
+
+
+def bind_socket(port: int, reuse_port: bool = True) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((config.HOST, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+class DrainingServer(uvicorn.Server):
+    """On SIGTERM/SIGINT, stops accepting and drains the node before uvicorn's own shutdown."""
+
+    async def shutdown(self, sockets=None):
+        import main
+
+        # Closing the listener first sends reconnects to the other workers.
+        for server in self.servers:
+            server.close()
+        if not self.force_exit:
+            await main.drain_node()
+        await super().shutdown(sockets)
+
+
+def run_worker(own_port: int):
+    import main
+
+    sockets = [bind_socket(config.PORT)]
+    if own_port:
+        # Only this worker listens here, so affinity routing can address it directly.
+        sockets.append(bind_socket(own_port, reuse_port=False))
+    from ws_compression import DeflateWebSocketProtocol
+
+    server = DrainingServer(uvicorn.Config(
+        main.app, log_level="warning",
+        ws=DeflateWebSocketProtocol, ws_per_message_deflate=config.WS_DEFLATE,
+    ))
+    server.run(sockets=sockets)
+
+
+def spawn(ctx, index: int, base: str):
+    node_id = f"{base}-{index}-{uuid.uuid4().hex[:6]}"
+    own_port = config.SIGNALING_WORKER_PORT_BASE + index if config.SIGNALING_WORKER_PORT_BASE else 0
+    # The spawned interpreter inherits the environment, so config reads these on import.
+    os.environ["SIGNALING_NODE_ID"] = node_id
+    if own_port:
+        os.environ["SIGNALING_ADVERTISE_URL"] = f"ws://{config.SIGNALING_PUBLIC_HOST}:{own_port}"
+    process = ctx.Process(target=run_worker, args=(own_port,), name=f"signaling-{index}")
+    process.start()
+    print(f"Worker {index} started as node {node_id} (pid {process.pid})")
+    return process
+
+
+def main():
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise SystemExit("SO_REUSEPORT is not available on this platform; run main.py instead")
+
+    # spawn, not fork: each worker builds its own event loop, Redis pools and gRPC channel.
+    ctx = multiprocessing.get_context("spawn")
+    base = os.getenv("SIGNALING_NODE_ID", uuid.uuid4().hex[:8])
+    workers = [spawn(ctx, i, base) for i in range(config.SIGNALING_WORKERS)]
+    print(f"Serving on {config.HOST}:{config.PORT} with {len(workers)} workers")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in workers:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while not stopping:
+        for i, process in enumerate(workers):
+            if not process.is_alive() and not stopping:
+                print(f"Worker {i} (pid {process.pid}) exited with {process.exitcode}, restarting")
+                workers[i] = spawn(ctx, i, base)
+        time.sleep(0.5)
+
+    for process in workers:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
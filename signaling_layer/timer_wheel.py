@@ -0,0 +1,60 @@
+import math
+
+
+class TimerWheel:
+    """Two-level hashed timer wheel.
+
+    The inner wheel has one slot per tick; the outer wheel has one slot per
+    full turn of the inner wheel. schedule() and cancel() are O(1), and
+    advance() only touches the slot that is due, plus one outer slot per
+    inner turn whose items are cascaded down. Timers further out than the
+    outer wheel reaches are parked in its last slot and re-placed when they
+    cascade.
+    """
+
+    def __init__(self, tick: float, inner_slots: int = 64, outer_slots: int = 64):
+        self.tick = tick
+        self.inner = [set() for _ in range(inner_slots)]
+        self.outer = [set() for _ in range(outer_slots)]
+        self.now = 0
+        # item -> (wheel, slot index, due tick)
+        self.where = {}
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, item, delay: float):
+        self.cancel(item)
+        self._place(item, self.now + max(1, math.ceil(delay / self.tick)))
+
+    def cancel(self, item):
+        entry = self.where.pop(item, None)
+        if entry is not None:
+            wheel, index, _ = entry
+            wheel[index].discard(item)
+
+    def _place(self, item, due: int):
+        turn = len(self.inner)
+        if due - self.now < turn:
+            wheel, index = self.inner, due % turn
+        else:
+            due_turn = min(due // turn, self.now // turn + len(self.outer) - 1)
+            wheel, index = self.outer, due_turn % len(self.outer)
+        wheel[index].add(item)
+        self.where[item] = (wheel, index, due)
+
+    def advance(self) -> set:
+        """Moves one tick forward and returns the items that are now due."""
+        self.now += 1
+        turn = len(self.inner)
+        if self.now % turn == 0:
+            index = (self.now // turn) % len(self.outer)
+            cascading, self.outer[index] = self.outer[index], set()
+            for item in cascading:
+                self._place(item, max(self.where[item][2], self.now))
+
+        index = self.now % turn
+        due, self.inner[index] = self.inner[index], set()
+        for item in due:
+            del self.where[item]
+        return due
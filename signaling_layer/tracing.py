@@ -0,0 +1,212 @@
+"""Join-path tracing, kept in memory on this node.
+
+Every join gets a trace: a root span for the whole join and a child span per
+stage (accept, ValidateJoin, connect, subscribe, presence, UserJoined,
+existing_users, the first publish). When the root finishes, the trace is
+kept in a ring buffer of the last TRACE_BUFFER traces if it was sampled
+(TRACE_SAMPLE_RATE) or took at least TRACE_SLOW_MS, and dropped otherwise,
+so slow outliers can be read from /stats/traces without a collector.
+
+gRPC calls made inside a trace carry a W3C `traceparent` header, and the
+management layer records its side (servicer and SQL spans) under the same
+trace id in its own /stats/traces.
+"""
+import collections
+import contextvars
+import os
+import random
+import time
+from contextlib import contextmanager
+
+import config
+
+# A runaway trace stops growing here instead of holding on to memory.
+MAX_SPANS = 64
+
+_current = contextvars.ContextVar("trace_span", default=None)
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "start", "end", "attrs", "token")
+
+    def __init__(self, trace, parent_id, name: str, attrs: dict):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.perf_counter()
+        self.end = None
+        self.attrs = attrs
+        self.token = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def finish(self, **attrs):
+        """Ends a root span started with Tracer.start; safe to call more than once."""
+        if self.end is not None:
+            return
+        self.attrs.update(attrs)
+        self.end = time.perf_counter()
+        if self.token is not None:
+            _current.reset(self.token)
+            self.token = None
+        tracer.finish(self.trace)
+
+    def to_dict(self, origin: float) -> dict:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "offset_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round((self.end - self.start) * 1000, 3) if self.end is not None else None,
+            "attrs": self.attrs,
+        }
+
+
+class _NoopSpan:
+    """Stands in for a span when nothing is being traced, so callers never branch."""
+
+    span_id = None
+
+    def set(self, **attrs):
+        pass
+
+    def finish(self, **attrs):
+        pass
+
+
+NOOP = _NoopSpan()
+
+
+class Trace:
+    __slots__ = ("trace_id", "sampled", "started_at", "spans", "done")
+
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.started_at = time.time()
+        self.spans = []
+        self.done = False
+
+    def add(self, parent_id, name: str, attrs: dict):
+        if len(self.spans) >= MAX_SPANS:
+            return NOOP
+        span = Span(self, parent_id, name, attrs)
+        self.spans.append(span)
+        return span
+
+    @property
+    def root(self) -> Span:
+        return self.spans[0]
+
+    @property
+    def duration_ms(self) -> float:
+        root = self.root
+        return (root.end - root.start) * 1000 if root.end is not None else 0.0
+
+    def to_dict(self) -> dict:
+        root = self.root
+        return {
+            "trace_id": self.trace_id,
+            "name": root.name,
+            "span_id": root.span_id,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration_ms, 3),
+            "sampled": self.sampled,
+            "attrs": root.attrs,
+            "spans": [span.to_dict(root.start) for span in self.spans[1:]],
+        }
+
+
+class Tracer:
+    def __init__(self):
+        self.buffer = collections.deque(maxlen=config.TRACE_BUFFER)
+        self.started = 0
+        self.kept_sampled = 0
+        self.kept_slow = 0
+
+    @property
+    def enabled(self) -> bool:
+        return config.TRACE_SAMPLE_RATE > 0 or config.TRACE_SLOW_MS > 0
+
+    def start(self, name: str, **attrs):
+        """Starts a trace and makes its root the current span until finish()."""
+        if not self.enabled:
+            return NOOP
+        trace = Trace(os.urandom(16).hex(), random.random() < config.TRACE_SAMPLE_RATE)
+        root = trace.add(None, name, attrs)
+        root.token = _current.set(root)
+        self.started += 1
+        return root
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """Times a stage as a child of the current span; a no-op outside a trace."""
+        parent = _current.get()
+        if parent is None or parent.trace.done:
+            yield NOOP
+            return
+        span = parent.trace.add(parent.span_id, name, attrs)
+        if span is NOOP:
+            yield NOOP
+            return
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.attrs["error"] = type(e).__name__
+            raise
+        finally:
+            span.end = time.perf_counter()
+            _current.reset(token)
+
+    def annotate(self, **attrs):
+        """Adds attributes to the current span, if there is one."""
+        span = _current.get()
+        if span is not None and not span.trace.done:
+            span.attrs.update(attrs)
+
+    def finish(self, trace: Trace):
+        trace.done = True
+        if trace.sampled:
+            self.kept_sampled += 1
+        elif config.TRACE_SLOW_MS > 0 and trace.duration_ms >= config.TRACE_SLOW_MS:
+            self.kept_slow += 1
+        else:
+            return
+        self.buffer.append(trace)
+
+    def dump(self, min_ms: float = 0, limit: int = 50, trace_id: str = None) -> dict:
+        traces = []
+        for trace in reversed(self.buffer):
+            if trace_id is not None and trace.trace_id != trace_id:
+                continue
+            if trace.duration_ms < min_ms:
+                continue
+            traces.append(trace.to_dict())
+            if len(traces) >= limit:
+                break
+        return {"stats": self.stats(), "traces": traces}
+
+    def stats(self) -> dict:
+        return {
+            "sample_rate": config.TRACE_SAMPLE_RATE,
+            "slow_ms": config.TRACE_SLOW_MS,
+            "started": self.started,
+            "kept_sampled": self.kept_sampled,
+            "kept_slow": self.kept_slow,
+            "buffered": len(self.buffer),
+        }
+
+
+tracer = Tracer()
+
+
+def grpc_metadata(metadata: tuple) -> tuple:
+    """Adds the current span as a W3C traceparent to outgoing gRPC metadata."""
+    span = _current.get()
+    if span is None or span.trace.done:
+        return metadata
+    flags = "01" if span.trace.sampled else "00"
+    return metadata + (("traceparent", f"00-{span.trace.trace_id}-{span.span_id}-{flags}"),)
@@ -0,0 +1,151 @@
+"""permessage-deflate for client sockets, with a size threshold and cost accounting.
+
+uvicorn's default negotiates deflate with fixed settings and compresses every
+frame, including the small signaling messages that make up most of the
+traffic. DeflateWebSocketProtocol replaces that extension with one that:
+
+- only compresses messages of at least WS_DEFLATE_THRESHOLD bytes (RFC 7692
+  lets each message choose), so SDP and history bursts shrink while ICE
+  candidates and acks skip zlib entirely;
+- uses the configured window bits, memLevel and context takeover;
+- records bytes, CPU time and per-socket zlib memory in `deflate_metrics`.
+
+    uvicorn.run(app, ws=DeflateWebSocketProtocol, ws_per_message_deflate=config.WS_DEFLATE)
+"""
+import time
+
+from uvicorn.protocols.websockets.websockets_sansio_impl import WebSocketsSansIOProtocol
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import CONT, CTRL_OPCODES
+
+import config
+
+# zlib's default when compress_settings doesn't set memLevel.
+DEFAULT_MEM_LEVEL = 8
+# Inflate state besides the window (struct inflate_state, fixed tables).
+INFLATE_OVERHEAD = 7 * 1024
+
+
+class DeflateMetrics:
+    """Counters shared by every deflate-enabled socket on this node."""
+
+    def __init__(self):
+        # Extensions of sockets that are still open.
+        self.active = set()
+        self.negotiated = 0
+
+        self.compressed = 0
+        self.skipped = 0
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.compress_seconds = 0.0
+
+        self.inflated = 0
+        self.inflated_wire_bytes = 0
+        self.inflated_raw_bytes = 0
+        self.decompress_seconds = 0.0
+
+    def stats(self) -> dict:
+        memory = [ext.zlib_memory() for ext in self.active]
+        return {
+            "enabled": config.WS_DEFLATE,
+            "threshold": config.WS_DEFLATE_THRESHOLD,
+            "negotiated": self.negotiated,
+            "active": len(memory),
+            "compressed": self.compressed,
+            "skipped": self.skipped,
+            "raw_bytes": self.raw_bytes,
+            "wire_bytes": self.wire_bytes,
+            "ratio": round(self.wire_bytes / self.raw_bytes, 4) if self.raw_bytes else None,
+            "compress_us_per_message": round(self.compress_seconds / self.compressed * 1e6, 2) if self.compressed else None,
+            "inflated": self.inflated,
+            "inflate_ratio": round(self.inflated_wire_bytes / self.inflated_raw_bytes, 4) if self.inflated_raw_bytes else None,
+            "decompress_us_per_message": round(self.decompress_seconds / self.inflated * 1e6, 2) if self.inflated else None,
+            "zlib_bytes_per_socket": round(sum(memory) / len(memory)) if memory else 0,
+            "zlib_bytes_total": sum(memory),
+        }
+
+
+deflate_metrics = DeflateMetrics()
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    """PerMessageDeflate that sends small single-frame messages uncompressed."""
+
+    def zlib_memory(self) -> int:
+        """zlib's documented footprint for the state this socket keeps between messages."""
+        memory = 0
+        if not self.local_no_context_takeover:
+            mem_level = self.compress_settings.get("memLevel", DEFAULT_MEM_LEVEL)
+            memory += (1 << (self.local_max_window_bits + 2)) + (1 << (mem_level + 9))
+        if not self.remote_no_context_takeover:
+            memory += (1 << self.remote_max_window_bits) + INFLATE_OVERHEAD
+        return memory
+
+    def encode(self, frame):
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+        # A message sent as one frame can skip compression; the rest of a
+        # fragmented message has to follow whatever its first frame did.
+        if frame.fin and frame.opcode is not CONT and len(frame.data) < config.WS_DEFLATE_THRESHOLD:
+            deflate_metrics.skipped += 1
+            return frame
+
+        start = time.perf_counter()
+        encoded = super().encode(frame)
+        deflate_metrics.compress_seconds += time.perf_counter() - start
+        deflate_metrics.compressed += 1
+        deflate_metrics.raw_bytes += len(frame.data)
+        deflate_metrics.wire_bytes += len(encoded.data)
+        return encoded
+
+    def decode(self, frame, *, max_size=None):
+        if frame.opcode in CTRL_OPCODES or not (frame.rsv1 or self.decode_cont_data):
+            return super().decode(frame, max_size=max_size)
+
+        start = time.perf_counter()
+        decoded = super().decode(frame, max_size=max_size)
+        deflate_metrics.decompress_seconds += time.perf_counter() - start
+        deflate_metrics.inflated += 1
+        deflate_metrics.inflated_wire_bytes += len(frame.data)
+        deflate_metrics.inflated_raw_bytes += len(decoded.data)
+        return decoded
+
+
+class ThresholdDeflateFactory(ServerPerMessageDeflateFactory):
+    def process_request_params(self, params, accepted_extensions):
+        response, negotiated = super().process_request_params(params, accepted_extensions)
+        extension = ThresholdPerMessageDeflate(
+            negotiated.remote_no_context_takeover,
+            negotiated.local_no_context_takeover,
+            negotiated.remote_max_window_bits,
+            negotiated.local_max_window_bits,
+            negotiated.compress_settings,
+        )
+        deflate_metrics.negotiated += 1
+        deflate_metrics.active.add(extension)
+        return response, extension
+
+
+# Built at import so out-of-range settings fail at startup, not on the first handshake.
+deflate_factory = ThresholdDeflateFactory(
+    server_no_context_takeover=config.WS_DEFLATE_NO_CONTEXT_TAKEOVER,
+    client_no_context_takeover=config.WS_DEFLATE_NO_CONTEXT_TAKEOVER,
+    server_max_window_bits=config.WS_DEFLATE_WINDOW_BITS,
+    client_max_window_bits=config.WS_DEFLATE_CLIENT_WINDOW_BITS,
+    compress_settings={"memLevel": config.WS_DEFLATE_MEM_LEVEL},
+)
+
+
+class DeflateWebSocketProtocol(WebSocketsSansIOProtocol):
+    """uvicorn's websockets protocol, offering the thresholded extension instead of its fixed one."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.config.ws_per_message_deflate:
+            self.conn.available_extensions = [deflate_factory]
+
+    def connection_lost(self, exc):
+        for extension in self.conn.extensions:
+            deflate_metrics.active.discard(extension)
+        super().connection_lost(exc)